@@ -0,0 +1,191 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import rollnw
+from lsprotocol import types as lsp
+from pygls.protocol import default_converter
+
+from .reference_index import SymbolKey
+from .script_context import ScriptContext, script_name
+from .stats import Stats
+from .symbol_cache import content_hash
+from .workers import CancellationToken
+
+# Parsing and resolution shared by the server and the index processes.  Kept
+# apart from the server module so that importing it has no side effects.
+
+CONVERTER = default_converter()
+
+
+def convert_position(position: rollnw.script.SourcePosition) -> lsp.Position:
+    return lsp.Position(position.line - 1, position.column)
+
+
+def convert_range(range: rollnw.script.SourceRange) -> lsp.Range:
+    return lsp.Range(convert_position(range.start), convert_position(range.end))
+
+
+def _symbol_to_doc_symbol(script, symbol):
+    name = symbol.decl.identifier()
+    range = symbol.decl.range()
+    selection_range = symbol.decl.selection_range()
+
+    if isinstance(symbol.decl, rollnw.script.VarDecl):
+        kind = lsp.SymbolKind.Variable
+        detail = "(variable)"
+    elif isinstance(symbol.decl, rollnw.script.FunctionDefinition):
+        kind = lsp.SymbolKind.Function
+        detail = "(function)"
+    elif isinstance(symbol.decl, rollnw.script.FunctionDecl):
+        kind = lsp.SymbolKind.Function
+        detail = "(function)"
+    elif isinstance(symbol.decl, rollnw.script.StructDecl):
+        kind = lsp.SymbolKind.Struct
+        detail = "(struct)"
+
+    return lsp.DocumentSymbol(name=name,
+                              kind=kind,
+                              range=convert_range(range),
+                              selection_range=convert_range(selection_range),
+                              detail=detail)
+
+
+def document_symbols(nss: rollnw.script.Nss) -> List[lsp.DocumentSymbol]:
+    return [_symbol_to_doc_symbol(nss, symbol) for symbol in nss.exports()]
+
+
+def parse_nss(script_context: ScriptContext, stats: Stats, paths: List[str], source: str,
+              is_command_script: bool, cancel: Optional[CancellationToken] = None
+              ) -> Tuple[rollnw.script.Nss, List[str], List[lsp.DocumentSymbol]]:
+    """Parses, includes and resolves a script.  Runs on a worker thread.
+
+    The context lock is released between phases so that queries from other
+    requests can run while a large script is processed, and ``cancel`` is
+    checked so that abandoned work stops at the next phase.
+    """
+    with script_context.lock, stats.timer("phase", "parse"):
+        if cancel is not None:
+            cancel.check()
+        ctx = script_context.get(paths)
+        nss = rollnw.script.Nss.from_string(source, ctx, is_command_script)
+        nss.parse()
+
+    with script_context.lock, stats.timer("phase", "includes"):
+        if cancel is not None:
+            cancel.check()
+        nss.process_includes()
+        # Includes are now in the context, record them before a cancelled
+        # script is thrown away so that changes to them still invalidate it
+        script_context.record_includes(nss)
+
+    with script_context.lock:
+        with stats.timer("phase", "resolve"):
+            if cancel is not None:
+                cancel.check()
+            nss.resolve()
+            # Indirect includes too, the dependency graph may never see the
+            # scripts in between parsed on their own
+            dependencies = sorted(script_context.record_includes(nss))
+        with stats.timer("phase", "convert"):
+            symbols = document_symbols(nss)
+
+    return nss, dependencies, symbols
+
+
+def reference_key(symbol: rollnw.script.Symbol, script: str) -> Optional[SymbolKey]:
+    """Gets the workspace wide key of the declaration of ``symbol``."""
+    if symbol.decl is None:
+        return None
+
+    if symbol.provider is not None:
+        script = script_name(symbol.provider.name())
+
+    name = symbol.decl.identifier()
+    if symbol.kind in (rollnw.script.SymbolKind.function, rollnw.script.SymbolKind.type):
+        return SymbolKey(script, name)
+
+    start = symbol.decl.selection_range().start
+    return SymbolKey(script, name, start.line - 1, start.column)
+
+
+def resolve_identifiers(script_context: ScriptContext, paths: List[str], nss: rollnw.script.Nss,
+                        source: str, callback: Callable[[rollnw.script.NssToken, rollnw.script.Symbol], None],
+                        cancel: Optional[CancellationToken] = None):
+    """Calls ``callback(token, symbol)`` for every identifier in a script.
+
+    Runs on a worker thread.  The context lock is released every few hundred
+    identifiers so that a long scan does not hold up interactive requests,
+    which is also when ``cancel`` is checked.
+    """
+    script_context.lock.acquire()
+    try:
+        lexer = rollnw.script.NssLexer(source, script_context.get(paths))
+        count = 0
+        while True:
+            token = lexer.next()
+            if token.type == rollnw.script.NssTokenType.END:
+                break
+            if token.type != rollnw.script.NssTokenType.IDENTIFIER:
+                continue
+
+            start = token.loc.range.start
+            callback(token, nss.locate_symbol(token.loc.view, start.line, start.column))
+
+            count += 1
+            if count % 256 == 0:
+                if cancel is not None:
+                    cancel.check()
+                script_context.lock.release()
+                script_context.lock.acquire()
+    finally:
+        script_context.lock.release()
+
+
+def scan_references(script_context: ScriptContext, paths: List[str], nss: rollnw.script.Nss,
+                    source: str, script: str, cancel: Optional[CancellationToken] = None) -> List[list]:
+    """Resolves every identifier in a script to its declaration."""
+    references = []
+
+    def add(token, symbol):
+        key = reference_key(symbol, script)
+        if key is not None:
+            start = token.loc.range.start
+            end = token.loc.range.end
+            references.append([*key, start.line - 1, start.column, end.line - 1, end.column])
+
+    resolve_identifiers(script_context, paths, nss, source, add, cancel)
+    return references
+
+
+def read_script(path: str) -> str:
+    """Reads a script from disk as the editor would show it."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def index_script(script_context: ScriptContext, stats: Stats, path: str, include_paths: List[str],
+                 digest: Optional[str], cancel: Optional[CancellationToken] = None
+                 ) -> Optional[Dict[str, Any]]:
+    """Parses and resolves the script at ``path`` as it is on disk.
+
+    Returns plain data that can be sent between processes: the content
+    hash, includes, exports and references of the script, in the form the
+    symbol cache stores them.  Returns ``None`` if the content still hashes
+    to ``digest``, i.e. the indexes are already up to date.
+    """
+    source = read_script(path)
+    source_digest = content_hash(source)
+    if source_digest == digest:
+        return None
+
+    name = script_name(path)
+    nss, dependencies, symbols = parse_nss(
+        script_context, stats, include_paths, source, name == "nwscript", cancel)
+    references = scan_references(script_context, include_paths, nss, source, name, cancel)
+
+    return {
+        "path": path,
+        "hash": source_digest,
+        "includes": dependencies,
+        "exports": [CONVERTER.unstructure(symbol) for symbol in symbols],
+        "references": references,
+    }
@@ -2,6 +2,8 @@ import argparse
 import logging
 import sys
 from . import __version__
+from .daemon import Daemon
+from .recorder import SessionRecorder
 from .server import SERVER
 
 
@@ -21,6 +23,7 @@ Examples:
 
     Run over stdio     : nwscriptd
     Run over tcp       : nwscriptd --tcp
+    Run a shared daemon: nwscriptd --daemon
     Run over websockets:
         # only need to pip install once per env
         pip install pygls[ws]
@@ -48,6 +51,12 @@ Notes:
         help="use web socket server instead of stdio",
         action="store_true",
     )
+    parser.add_argument(
+        "--daemon",
+        help="serve any number of clients over TCP from one process, sharing "
+             "the rollnw kernel and workspace indexes between them",
+        action="store_true",
+    )
     parser.add_argument(
         "--host",
         help="host for web server (default 127.0.0.1)",
@@ -65,6 +74,27 @@ Notes:
         help="redirect logs to file specified",
         type=str,
     )
+    parser.add_argument(
+        "--no-install",
+        help="disable loading game install files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-user",
+        help="disable loading user directory files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--record",
+        help="record all JSON-RPC messages to the JSON lines file specified",
+        type=str,
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="log latency statistics every N seconds (default 0, disabled)",
+        type=float,
+        default=0,
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -82,6 +112,12 @@ Notes:
             file=sys.stderr,
         )
         sys.exit(1)
+    if args.daemon and (args.ws or args.record):
+        print(
+            "Error: --daemon cannot be combined with --ws or --record",
+            file=sys.stderr,
+        )
+        sys.exit(1)
     log_level = {0: logging.WARN, 1: logging.INFO, 2: logging.DEBUG}.get(
         args.verbose,
         logging.DEBUG,
@@ -96,9 +132,25 @@ Notes:
     else:
         logging.basicConfig(stream=sys.stderr, level=log_level)
 
-    if args.tcp:
-        SERVER.start_tcp(host=args.host, port=args.port)
-    elif args.ws:
-        SERVER.start_ws(host=args.host, port=args.port)
-    else:
-        SERVER.start_io()
+    if args.stats_interval > 0:
+        logging.getLogger("arclight.nwscriptd.server").setLevel(logging.INFO)
+        SERVER.loop.call_later(args.stats_interval, SERVER.dump_stats, args.stats_interval)
+
+    SERVER.kernel.include_install = not args.no_install
+    SERVER.kernel.include_user = not args.no_user
+
+    if args.record:
+        SERVER.recorder = SessionRecorder(args.record)
+
+    try:
+        if args.daemon:
+            Daemon(SERVER).start_tcp(host=args.host, port=args.port)
+        elif args.tcp:
+            SERVER.start_tcp(host=args.host, port=args.port)
+        elif args.ws:
+            SERVER.start_ws(host=args.host, port=args.port)
+        else:
+            SERVER.start_io()
+    finally:
+        if SERVER.recorder is not None:
+            SERVER.recorder.close()
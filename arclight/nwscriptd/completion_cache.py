@@ -0,0 +1,38 @@
+from typing import Dict, List, Optional, Tuple
+
+from lsprotocol import types as lsp
+
+
+class CompletionItemCache:
+    """Prebuilt completion items for the exports of include scripts.
+
+    Items are keyed by script name and revision, only the latest revision of
+    each script is retained.  Building the items for ``nwscript.nss`` means
+    creating well over a thousand items and snippets, so this is done once
+    per revision rather than on every completion request.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple[int, List[lsp.CompletionItem]]] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, name: str, revision: int) -> Optional[List[lsp.CompletionItem]]:
+        """Gets the items of script ``name`` if they were built at ``revision``."""
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != revision:
+            return None
+        return entry[1]
+
+    def put(self, name: str, revision: int, items: List[lsp.CompletionItem]):
+        self._entries[name] = (revision, items)
+
+    def remove(self, name: str):
+        self._entries.pop(name, None)
+
+    def clear(self):
+        self._entries.clear()
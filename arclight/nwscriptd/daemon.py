@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from typing import TYPE_CHECKING, Dict, List
+
+from .workspace_state import WorkspaceState
+
+if TYPE_CHECKING:
+    from .server import NWScriptLanguageServer
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """Serves any number of clients from one long running process.
+
+    Every connection gets a language server and protocol of its own, made by
+    :meth:`NWScriptLanguageServer.spawn`, so each client's open documents,
+    diagnostics and options are kept apart.  The rollnw kernel, the worker
+    pool and the statistics are shared by all clients, and the caches and
+    indexes of a workspace by every client that opens it, so a workspace is
+    only indexed once however many editors are connected.  A workspace's
+    :class:`WorkspaceState` is kept after its last client disconnects, ready
+    for the next.
+    """
+
+    def __init__(self, template: "NWScriptLanguageServer"):
+        self.template = template
+        self.clients: List["NWScriptLanguageServer"] = []
+        self._workspaces: Dict[str, WorkspaceState] = {}
+        # The clients watching the files of each workspace, the first of
+        # which applies their changes to the shared state
+        self._watchers: Dict[str, List["NWScriptLanguageServer"]] = {}
+
+    def connect(self):
+        """Creates the protocol of a new connection, for ``loop.create_server``."""
+        server = self.template.spawn()
+        server.daemon = self
+        self.clients.append(server)
+        logger.info("Client connected, %d connected", len(self.clients))
+        return server.lsp
+
+    def disconnect(self, server: "NWScriptLanguageServer"):
+        """Forgets a client whose connection has closed."""
+        if server not in self.clients:
+            return
+
+        self.clients.remove(server)
+        watchers = self._watchers.get(server.workspace_root, [])
+        if server in watchers:
+            watchers.remove(server)
+        server.diagnostics_debouncer.cancel_all()
+        server.reference_debouncer.cancel_all()
+        server.cancel_prefetch()
+        server.workers.cancel(lambda key: key[1] == server.session_id)
+        logger.info("Client disconnected, %d connected", len(self.clients))
+
+    def attach(self, server: "NWScriptLanguageServer", root_path: str) -> bool:
+        """Shares the state of the workspace at ``root_path`` with ``server``.
+
+        Returns ``False`` if ``server`` is the first to open the workspace, in
+        which case its own state becomes the shared one and it must build it.
+        """
+        root = os.path.normcase(os.path.abspath(root_path))
+        server.workspace_root = root
+
+        state = self._workspaces.get(root)
+        if state is None:
+            self._workspaces[root] = server.workspace_state
+            return False
+
+        server.workspace_state = state
+        return True
+
+    def watch(self, server: "NWScriptLanguageServer"):
+        """Records that ``server`` is watching the files of its workspace."""
+        if server.workspace_root is not None:
+            self._watchers.setdefault(server.workspace_root, []).append(server)
+
+    def handles_watched_files(self, server: "NWScriptLanguageServer") -> bool:
+        """Whether the file changes reported by ``server`` are to be applied.
+
+        Every client watches the files of its workspace, so each change is
+        reported once by each of them.  Only the reports of the longest
+        connected watcher are applied to the shared state.
+        """
+        watchers = self._watchers.get(server.workspace_root)
+        return not watchers or watchers[0] is server
+
+    def peers(self, server: "NWScriptLanguageServer") -> List["NWScriptLanguageServer"]:
+        """Gets the clients sharing the workspace of ``server``, including itself."""
+        if server.workspace_root is None:
+            return [server]
+        return [c for c in self.clients if c.workspace_root == server.workspace_root]
+
+    def save(self):
+        """Writes the symbol cache of every workspace."""
+        for state in self._workspaces.values():
+            cache = state.symbol_cache
+            if cache is not None:
+                cache.save()
+
+    def start_tcp(self, host: str, port: int):
+        """Serves clients connecting to ``host``:``port`` until interrupted."""
+        loop = self.template.loop
+        server = loop.run_until_complete(loop.create_server(self.connect, host, port))
+        logger.info("Serving nwscriptd clients on %s:%s", host, port)
+        try:
+            loop.run_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.save()
+            self.template.workers.shutdown()
+            # Let cancelled handlers and closed transports finish up
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Callable, Dict, Hashable
+
+
+class Debouncer:
+    """Coalesces bursts of calls per key into a single deferred call.
+
+    Every call to :meth:`schedule` restarts the quiet period for its key, so
+    only the last callback scheduled for a key runs, ``delay`` seconds after
+    the burst ends.  Coroutine functions are run as tasks on the loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, delay: float = 0.3):
+        self.loop = loop
+        self.delay = delay
+        self._handles: Dict[Hashable, asyncio.TimerHandle] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._handles
+
+    def schedule(self, key: Hashable, callback: Callable[..., Any], *args):
+        """Schedules ``callback(*args)``, replacing anything pending for ``key``."""
+        self.cancel(key)
+        self._handles[key] = self.loop.call_later(
+            self.delay, self._fire, key, callback, args)
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancels the pending call for ``key``, if any."""
+        handle = self._handles.pop(key, None)
+        if handle is None:
+            return False
+
+        handle.cancel()
+        return True
+
+    def cancel_all(self):
+        """Cancels every pending call."""
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+
+    def _fire(self, key: Hashable, callback: Callable[..., Any], args):
+        self._handles.pop(key, None)
+        result = callback(*args)
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(result)
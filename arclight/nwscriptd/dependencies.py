@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, Set
+
+
+class DependencyGraph:
+    """Include relationships between scripts, keyed by script name.
+
+    Both directions are kept so that the scripts affected by a change to an
+    include can be found without scanning the workspace.  Each script also
+    has a revision that is bumped whenever it changes on disk.
+    """
+
+    def __init__(self):
+        self._includes: Dict[str, Set[str]] = {}
+        self._dependents: Dict[str, Set[str]] = {}
+        self._revisions: Dict[str, int] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._includes
+
+    def __len__(self) -> int:
+        return len(self._includes)
+
+    def set_includes(self, name: str, includes: Iterable[str]):
+        """Replaces the includes recorded for the script ``name``."""
+        self.remove(name)
+        includes = {include.lower() for include in includes}
+        self._includes[name] = includes
+        for include in includes:
+            self._dependents.setdefault(include, set()).add(name)
+
+    def remove(self, name: str):
+        """Forgets the includes of the script ``name``."""
+        for include in self._includes.pop(name, ()):
+            dependents = self._dependents.get(include)
+            if dependents is not None:
+                dependents.discard(name)
+                if not dependents:
+                    del self._dependents[include]
+
+    def includes(self, name: str) -> Set[str]:
+        return set(self._includes.get(name, ()))
+
+    def dependents(self, name: str) -> Set[str]:
+        """Gets scripts that directly include ``name``."""
+        return set(self._dependents.get(name, ()))
+
+    def transitive_includes(self, name: str) -> Set[str]:
+        """Gets every script included by ``name``, directly or indirectly."""
+        result: Set[str] = set()
+        stack = [name]
+        while stack:
+            for include in self._includes.get(stack.pop(), ()):
+                if include not in result:
+                    result.add(include)
+                    stack.append(include)
+
+        result.discard(name)
+        return result
+
+    def revision(self, name: str) -> int:
+        return self._revisions.get(name, 0)
+
+    def touch(self, name: str):
+        """Records that the script ``name`` has changed."""
+        self._revisions[name] = self.revision(name) + 1
+
+    def fingerprint(self, name: str) -> str:
+        """Gets a string identifying the revisions of everything ``name`` includes."""
+        return ",".join(
+            f"{include}@{self.revision(include)}"
+            for include in sorted(self.transitive_includes(name))
+        )
+
+    def transitive_dependents(self, name: str) -> Set[str]:
+        """Gets every script that includes ``name``, directly or indirectly."""
+        result: Set[str] = set()
+        stack = [name]
+        while stack:
+            for dependent in self._dependents.get(stack.pop(), ()):
+                if dependent not in result:
+                    result.add(dependent)
+                    stack.append(dependent)
+
+        result.discard(name)
+        return result
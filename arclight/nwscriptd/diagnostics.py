@@ -0,0 +1,40 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from lsprotocol import types as lsp
+
+
+def make_result_id(salt: str, source: str, fingerprint: str) -> str:
+    """Derives a diagnostic report result id.
+
+    ``fingerprint`` identifies the state of every include of the document,
+    ``salt`` distinguishes server sessions so ids from a previous run are
+    never mistaken for current ones.
+    """
+    digest = hashlib.sha1(salt.encode())
+    digest.update(source.encode("utf-8", "surrogatepass"))
+    digest.update(b"\0")
+    digest.update(fingerprint.encode())
+    return digest.hexdigest()
+
+
+class DiagnosticReports:
+    """Last diagnostics computed for each document and their result id."""
+
+    def __init__(self):
+        self._reports: Dict[str, Tuple[str, List[lsp.Diagnostic]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._reports)
+
+    def get(self, uri: str, result_id: str) -> Optional[List[lsp.Diagnostic]]:
+        report = self._reports.get(uri)
+        if report is None or report[0] != result_id:
+            return None
+        return report[1]
+
+    def put(self, uri: str, result_id: str, diagnostics: List[lsp.Diagnostic]):
+        self._reports[uri] = (result_id, diagnostics)
+
+    def remove(self, uri: str):
+        self._reports.pop(uri, None)
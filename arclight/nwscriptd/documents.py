@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# rollnw gives no way to measure a script, its size is estimated from the
+# length of its source.  Parsed and resolved scripts are roughly an order of
+# magnitude larger than their source.
+SIZE_PER_CHAR = 10
+
+
+class DocumentCache:
+    """Cache of parsed and resolved scripts keyed by document URI and version.
+
+    Only the latest version of a document is retained, storing a newer
+    version replaces whatever was cached for that URI.
+
+    When a document is closed its script is kept, keyed by its URI and the
+    hash of its content, so that reopening an unchanged file does not parse
+    it again.
+    Closed scripts are evicted least recently used first once their
+    estimated size exceeds ``budget`` bytes.
+    """
+
+    def __init__(self, budget: int = 64 * 1024 * 1024):
+        self.budget = budget
+        self._entries: Dict[str, Tuple[int, Any, Optional[str], int]] = {}
+        self._closed: "OrderedDict[Tuple[str, str], Tuple[Any, int]]" = OrderedDict()
+        self._closed_size = 0
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uri: str, version: Optional[int]) -> Optional[Any]:
+        """Gets the cached script for ``uri`` if it matches ``version``."""
+        if version is None:
+            return None
+
+        entry = self._entries.get(uri)
+        if entry is None or entry[0] != version:
+            return None
+
+        return entry[1]
+
+    def put(self, uri: str, version: Optional[int], nss: Any,
+            digest: Optional[str] = None, length: int = 0):
+        """Caches ``nss`` as the parsed script of ``uri`` at ``version``.
+
+        ``digest`` and ``length`` are the content hash and length of the
+        source, needed to keep the script once the document is closed.
+        Documents without a version, i.e. those read from disk rather than
+        managed by the client, are not cached.
+        """
+        if version is None:
+            return
+
+        self._entries[uri] = (version, nss, digest, length * SIZE_PER_CHAR)
+
+    def remove(self, uri: str):
+        """Drops any cached script for ``uri``."""
+        self._entries.pop(uri, None)
+
+    def close(self, uri: str):
+        """Moves the script of a closed document to the closed scripts."""
+        entry = self._entries.pop(uri, None)
+        if entry is None or entry[2] is None:
+            return
+
+        _, nss, digest, size = entry
+        self._discard_closed((uri, digest))
+        self._closed[(uri, digest)] = (nss, size)
+        self._closed_size += size
+        while self._closed_size > self.budget and self._closed:
+            _, (_, size) = self._closed.popitem(last=False)
+            self._closed_size -= size
+
+    def reopen(self, uri: str, digest: str) -> Optional[Any]:
+        """Takes the script of the closed document ``uri`` if its content hash is ``digest``."""
+        entry = self._closed.pop((uri, digest), None)
+        if entry is None:
+            return None
+
+        self._closed_size -= entry[1]
+        return entry[0]
+
+    def _discard_closed(self, key: Tuple[str, str]):
+        entry = self._closed.pop(key, None)
+        if entry is not None:
+            self._closed_size -= entry[1]
+
+    def clear_closed(self):
+        """Drops all scripts of closed documents."""
+        self._closed.clear()
+        self._closed_size = 0
+
+    def clear(self):
+        self._entries.clear()
+        self.clear_closed()
+
+    def memory(self) -> Dict[str, int]:
+        """Reports the number and estimated size of cached scripts."""
+        return {
+            "open": len(self._entries),
+            "open_bytes": sum(entry[3] for entry in self._entries.values()),
+            "closed": len(self._closed),
+            "closed_bytes": self._closed_size,
+            "closed_budget": self.budget,
+        }
@@ -0,0 +1,64 @@
+import heapq
+from typing import Callable, Iterable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def fuzzy_score(pattern: str, candidate: str) -> Optional[int]:
+    """Scores how well ``candidate`` matches ``pattern``, higher is better.
+
+    Every character of ``pattern`` must appear in ``candidate`` in order,
+    ignoring case, otherwise ``None`` is returned.  Matches at the start of
+    the candidate, at word boundaries (``GetLocalInt``, ``inc_util``) and
+    runs of consecutive characters score higher, as do shorter candidates.
+    """
+    if not pattern:
+        return 0
+
+    needle = pattern.lower()
+    haystack = candidate.lower()
+    score = 0
+    pos = 0
+    last = -2
+    for i, ch in enumerate(haystack):
+        if pos == len(needle):
+            break
+        if ch != needle[pos]:
+            continue
+
+        bonus = 1
+        if i == last + 1:
+            bonus += 4
+        if i == 0:
+            bonus += 8
+        elif candidate[i - 1] == "_" or (candidate[i].isupper() and candidate[i - 1].islower()):
+            bonus += 6
+        if candidate[i] == pattern[pos]:
+            bonus += 1
+
+        score += bonus
+        last = i
+        pos += 1
+
+    if pos < len(needle):
+        return None
+
+    return score * 16 - len(candidate)
+
+
+def fuzzy_rank(pattern: str, items: Iterable[T], key: Callable[[T], str],
+               limit: Optional[int] = None) -> List[T]:
+    """Filters ``items`` matching ``pattern`` and sorts them best first."""
+    scored = []
+    for i, item in enumerate(items):
+        score = fuzzy_score(pattern, key(item))
+        if score is not None:
+            # The index keeps the sort stable and items never get compared
+            scored.append((score, -i, item))
+
+    if limit is None:
+        scored.sort(reverse=True, key=lambda s: (s[0], s[1]))
+    else:
+        scored = heapq.nlargest(limit, scored, key=lambda s: (s[0], s[1]))
+
+    return [item for _, _, item in scored]
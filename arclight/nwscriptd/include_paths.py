@@ -0,0 +1,92 @@
+import os
+from typing import Dict, Iterator, List, Optional, Set
+
+
+class IncludePathIndex:
+    """Index of workspace directories that contain nwscript files.
+
+    The index is built once with a full walk of the workspace and then kept
+    current by feeding it individual file creation and deletion events, so
+    that looking up the include paths never touches the file system.
+    """
+
+    def __init__(self, file_extension: str = ".nss"):
+        self.file_extension = file_extension
+        self._files: Dict[str, Set[str]] = {}
+        self._names: Dict[str, str] = {}
+        self._paths: Optional[List[str]] = None
+
+    def _name(self, file: str) -> str:
+        return file[:-len(self.file_extension)].lower()
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.normpath(path) in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def build(self, start_path: str):
+        """Walks ``start_path`` and replaces the contents of the index."""
+        self._files.clear()
+        self._names.clear()
+        self._paths = None
+        for root, dirs, files in os.walk(start_path):
+            matches = {f for f in files if f.endswith(self.file_extension)}
+            if matches:
+                root = os.path.normpath(root)
+                self._files[root] = matches
+                for file in matches:
+                    self._names.setdefault(self._name(file), os.path.join(root, file))
+
+    def add(self, path: str) -> bool:
+        """Adds a file to the index, returns ``True`` if a new directory was added."""
+        if not path.endswith(self.file_extension):
+            return False
+
+        root, file = os.path.split(os.path.normpath(path))
+        self._names.setdefault(self._name(file), os.path.join(root, file))
+        files = self._files.get(root)
+        if files is None:
+            self._files[root] = {file}
+            self._paths = None
+            return True
+
+        files.add(file)
+        return False
+
+    def remove(self, path: str) -> bool:
+        """Removes a file from the index, returns ``True`` if a directory was dropped."""
+        if not path.endswith(self.file_extension):
+            return False
+
+        root, file = os.path.split(os.path.normpath(path))
+        files = self._files.get(root)
+        if files is None:
+            return False
+
+        files.discard(file)
+        if self._names.get(self._name(file)) == os.path.join(root, file):
+            del self._names[self._name(file)]
+
+        if files:
+            return False
+
+        del self._files[root]
+        self._paths = None
+        return True
+
+    def files(self) -> Iterator[str]:
+        """Iterates over the paths of every file in the index."""
+        for root, files in self._files.items():
+            for file in files:
+                yield os.path.join(root, file)
+
+    def find(self, name: str) -> Optional[str]:
+        """Gets the path of the script ``name``, if it is in the workspace."""
+        return self._names.get(name.lower())
+
+    def paths(self) -> List[str]:
+        """Gets all directories containing at least one matching file."""
+        if self._paths is None:
+            self._paths = list(self._files)
+        return self._paths
@@ -0,0 +1,90 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+from lsprotocol import types as lsp
+
+Chunk = Tuple[List[Tuple[int, int]], List[lsp.InlayHint]]
+
+
+def _position_key(position: lsp.Position) -> Tuple[int, int]:
+    return position.line, position.character
+
+
+class InlayHintCache:
+    """Inlay hints of documents computed in fixed size chunks of lines.
+
+    Chunk ``n`` covers lines ``[n * chunk_lines, (n + 1) * chunk_lines)``.
+    Each chunk's hints are kept sorted by position, so the hints of any range
+    are sliced out with a binary search in the first and last chunk it
+    touches.  Only the latest version of a document is retained.
+    """
+
+    def __init__(self, chunk_lines: int = 200):
+        self.chunk_lines = chunk_lines
+        self._entries: Dict[str, Tuple[int, Dict[int, Chunk]]] = {}
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def chunks(self, start_line: int, end_line: int) -> List[int]:
+        """Gets the chunks overlapping the lines ``start_line`` to ``end_line``."""
+        return list(range(start_line // self.chunk_lines, end_line // self.chunk_lines + 1))
+
+    def chunk_range(self, chunk: int) -> lsp.Range:
+        """Gets the range of lines covered by ``chunk``."""
+        return lsp.Range(
+            lsp.Position(chunk * self.chunk_lines, 0),
+            lsp.Position((chunk + 1) * self.chunk_lines, 0),
+        )
+
+    def _get_chunks(self, uri: str, version: int) -> Optional[Dict[int, Chunk]]:
+        entry = self._entries.get(uri)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def missing(self, uri: str, version: int, start_line: int, end_line: int) -> List[int]:
+        """Gets the chunks overlapping the lines that have not been computed."""
+        chunks = self._get_chunks(uri, version) or {}
+        return [chunk for chunk in self.chunks(start_line, end_line) if chunk not in chunks]
+
+    def put(self, uri: str, version: int, chunk: int, hints: List[lsp.InlayHint]):
+        """Stores the hints of ``chunk``, dropping any outside of it."""
+        chunks = self._get_chunks(uri, version)
+        if chunks is None:
+            chunks = {}
+            self._entries[uri] = (version, chunks)
+
+        hints = sorted(
+            (hint for hint in hints if hint.position.line // self.chunk_lines == chunk),
+            key=lambda hint: _position_key(hint.position),
+        )
+        chunks[chunk] = ([_position_key(hint.position) for hint in hints], hints)
+
+    def get(self, uri: str, version: int, range: lsp.Range) -> Optional[List[lsp.InlayHint]]:
+        """Gets the hints within ``range``, or ``None`` if a chunk is missing."""
+        chunks = self._get_chunks(uri, version)
+        if chunks is None:
+            return None
+
+        start = _position_key(range.start)
+        end = _position_key(range.end)
+        result = []
+        for chunk in self.chunks(range.start.line, range.end.line):
+            entry = chunks.get(chunk)
+            if entry is None:
+                return None
+
+            keys, hints = entry
+            result.extend(hints[bisect.bisect_left(keys, start):bisect.bisect_right(keys, end)])
+
+        return result
+
+    def remove(self, uri: str):
+        self._entries.pop(uri, None)
+
+    def clear(self):
+        self._entries.clear()
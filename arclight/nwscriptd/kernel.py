@@ -0,0 +1,68 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Optional
+
+import rollnw
+
+from .scheduler import PriorityLock
+
+logger = logging.getLogger(__name__)
+
+
+def _start_kernel(lock: PriorityLock, include_install: bool, include_user: bool):
+    config = rollnw.kernel.config().options()
+    config.include_install = include_install
+    config.include_user = include_user
+
+    start = time.perf_counter()
+    with lock:
+        rollnw.kernel.start(config)
+    logger.info("rollnw kernel started in %.3fs", time.perf_counter() - start)
+
+
+class KernelLoader:
+    """Starts the rollnw kernel in the background.
+
+    Loading the game install and user directory can take seconds, so rather
+    than blocking ``initialize`` the kernel is started on a thread of its own,
+    leaving the worker pool free, and anything that needs it awaits
+    :meth:`wait`.  The kernel can only be started once per process.
+
+    ``include_install`` and ``include_user`` mirror ``nwscript-lint``'s
+    ``--no-install`` and ``--no-user`` options.
+    """
+
+    def __init__(self):
+        self.include_install = True
+        self.include_user = True
+        self._future: Optional[asyncio.Future] = None
+
+    @property
+    def started(self) -> bool:
+        """Whether the kernel has been asked to start."""
+        return self._future is not None
+
+    @property
+    def ready(self) -> bool:
+        """Whether the kernel has finished starting."""
+        return self._future is not None and self._future.done() \
+            and self._future.exception() is None
+
+    def start(self, lock: PriorityLock) -> asyncio.Future:
+        """Starts the kernel unless that has already happened.
+
+        ``lock`` is held while the kernel starts so no script work can run
+        concurrently.
+        """
+        if self._future is None:
+            self._future = asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                _start_kernel, lock, self.include_install, self.include_user))
+        return self._future
+
+    async def wait(self):
+        """Waits until the kernel has started."""
+        if self._future is None:
+            raise RuntimeError("The rollnw kernel has not been started")
+        await asyncio.shield(self._future)
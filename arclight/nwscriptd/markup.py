@@ -1,7 +1,59 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Set, Tuple
+
 from lsprotocol import types as lsp
 import rollnw.script as nws
 
 
+class MarkupCache:
+    """Bounded LRU cache of markup rendered for declarations from includes.
+
+    Keys are tuples whose first item is the name of the providing script, so
+    that everything rendered from a script can be dropped when it changes.
+    Callers should also include the script's revision in the key.  Markup is
+    rendered on worker threads, so the cache is guarded by its own lock.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[Hashable, ...], lsp.MarkupContent]" = OrderedDict()
+        self._by_provider: Dict[str, Set[Tuple[Hashable, ...]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[lsp.MarkupContent]:
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+            return content
+
+    def put(self, key: Tuple[Hashable, ...], content: lsp.MarkupContent):
+        with self._lock:
+            self._entries[key] = content
+            self._entries.move_to_end(key)
+            self._by_provider.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old, _ = self._entries.popitem(last=False)
+                self._discard(old)
+
+    def invalidate(self, provider: str):
+        """Drops all markup rendered for declarations of ``provider``."""
+        with self._lock:
+            for key in self._by_provider.pop(provider, ()):
+                self._entries.pop(key, None)
+
+    def _discard(self, key: Tuple[Hashable, ...]):
+        keys = self._by_provider.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_provider[key[0]]
+
+
 def code_block(string: str, markup_kind: lsp.MarkupKind) -> lsp.MarkupContent:
     if markup_kind == lsp.MarkupKind.Markdown:
         string = f"```nwscript\n{string}\n```"
@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from . import analysis
+from .kernel import _start_kernel
+from .script_context import ScriptContext
+from .stats import Stats
+
+# State of a pool process, set up once by its initializer
+_context: Optional[ScriptContext] = None
+
+
+def _init_process(include_install: bool, include_user: bool):
+    global _context
+
+    _context = ScriptContext()
+    _start_kernel(_context.lock, include_install, include_user)
+
+
+def index_script(path: str, include_paths: List[str], digest: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Parses and resolves the script at ``path`` in a pool process.
+
+    See :func:`.analysis.index_script` for what is returned.
+    """
+    return analysis.index_script(_context, Stats(), path, include_paths, digest)
+
+
+def default_processes() -> int:
+    """Gets the number of processes to index with, one per core less one for the server."""
+    return max((os.cpu_count() or 2) - 1, 1)
+
+
+def create_pool(processes: int, include_install: bool, include_user: bool) -> ProcessPoolExecutor:
+    """Creates a pool of processes that each start their own rollnw kernel.
+
+    Processes are spawned rather than forked, the server's threads and
+    kernel must not be copied into them.
+    """
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_process,
+        initargs=(include_install, include_user),
+    )
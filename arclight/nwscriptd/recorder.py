@@ -0,0 +1,40 @@
+import json
+import threading
+import time
+from typing import Any, Dict, Iterator
+
+
+class SessionRecorder:
+    """Records the JSON-RPC messages of a session to a JSON lines file.
+
+    Every line holds the seconds since recording started, the direction of
+    the message, ``"in"`` from the client or ``"out"`` to it, and the message
+    itself, so a session can later be replayed with its original timing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._file = open(path, "w", encoding="utf-8")
+
+    def record(self, direction: str, message: str):
+        """Records ``message``, which must already be serialized JSON."""
+        elapsed = time.perf_counter() - self._start
+        line = f'{{"time": {elapsed:.6f}, "direction": "{direction}", "message": {message}}}\n'
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_session(path: str) -> Iterator[Dict[str, Any]]:
+    """Reads the entries of a session recorded by :class:`SessionRecorder`."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
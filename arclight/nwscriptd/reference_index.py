@@ -0,0 +1,78 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class SymbolKey(NamedTuple):
+    """Identifies a declaration across the workspace.
+
+    Functions and structs are global and identified by the script providing
+    them and their name.  Anything else also carries the position of its
+    declaration, since e.g. two functions may both declare a local ``i``.
+    """
+
+    script: str
+    name: str
+    line: int = -1
+    character: int = -1
+
+
+# (start line, start character, end line, end character), zero based
+RangeTuple = Tuple[int, int, int, int]
+
+
+class ReferenceIndex:
+    """Index of every resolved identifier in the workspace by declaration.
+
+    Each script's references are stored with the hash of the content they
+    were computed from and are replaced as a unit, so the index is kept
+    current one file at a time and a query never needs to reparse anything.
+    """
+
+    def __init__(self):
+        self._by_path: Dict[str, Tuple[str, List[Tuple[SymbolKey, RangeTuple]]]] = {}
+        self._by_key: Dict[SymbolKey, Dict[str, List[RangeTuple]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_path)
+
+    def digest(self, path: str) -> Optional[str]:
+        """Gets the content hash the references of ``path`` were computed from."""
+        entry = self._by_path.get(path)
+        return entry[0] if entry is not None else None
+
+    def update(self, path: str, digest: str, references: Iterable[Sequence]):
+        """Replaces the references of the script at ``path``.
+
+        Each reference is a flat sequence of the four ``SymbolKey`` fields
+        followed by the four ``RangeTuple`` fields, as stored on disk.
+        """
+        self.remove(path)
+
+        entries = []
+        for ref in references:
+            key = SymbolKey(*ref[:4])
+            range = tuple(ref[4:8])
+            entries.append((key, range))
+            self._by_key.setdefault(key, {}).setdefault(path, []).append(range)
+
+        self._by_path[path] = (digest, entries)
+
+    def remove(self, path: str):
+        entry = self._by_path.pop(path, None)
+        if entry is None:
+            return
+
+        for key, _ in entry[1]:
+            paths = self._by_key.get(key)
+            if paths is None:
+                continue
+            paths.pop(path, None)
+            if not paths:
+                del self._by_key[key]
+
+    def references(self, key: SymbolKey) -> List[Tuple[str, RangeTuple]]:
+        """Gets the path and range of every reference to ``key``."""
+        return [
+            (path, range)
+            for path, ranges in self._by_key.get(key, {}).items()
+            for range in ranges
+        ]
@@ -0,0 +1,89 @@
+import contextvars
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+# Priority classes, lower runs first
+INTERACTIVE = 0
+DIAGNOSTICS = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    DIAGNOSTICS: "diagnostics",
+    BACKGROUND: "background",
+}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "nwscriptd_priority", default=INTERACTIVE)
+
+
+def current_priority() -> int:
+    """Gets the priority of the running task or worker thread."""
+    return _priority.get()
+
+
+@contextmanager
+def priority(value: int) -> Iterator[None]:
+    """Runs the ``with`` block, and any work it submits, at priority ``value``.
+
+    The priority is held in a context variable, so it follows an asyncio task
+    through everything it awaits.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_priority(value: int):
+    """Sets the priority of the current worker thread."""
+    _priority.set(value)
+
+
+class PriorityLock:
+    """Lock that is handed to the waiting thread of highest priority.
+
+    Threads of equal priority acquire it in the order they asked for it.
+    Long running work that releases and reacquires the lock between units
+    of work therefore yields to anything more urgent that is waiting.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._locked = False
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+
+    def acquire(self) -> bool:
+        with self._cond:
+            if not self._locked and not self._waiters:
+                self._locked = True
+                return True
+
+            entry = (current_priority(), next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            while self._locked or self._waiters[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiters)
+            self._locked = True
+            return True
+
+    def release(self):
+        with self._cond:
+            if not self._locked:
+                raise RuntimeError("release unlocked lock")
+            self._locked = False
+            self._cond.notify_all()
+
+    def locked(self) -> bool:
+        return self._locked
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
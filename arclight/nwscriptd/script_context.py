@@ -0,0 +1,102 @@
+import os
+from typing import Any, Callable, Iterable, Optional, Set
+
+import rollnw
+
+from .scheduler import PriorityLock
+
+
+def script_name(path: str) -> str:
+    """Gets the resref-style script name of a file path."""
+    return os.path.splitext(os.path.basename(path))[0].lower()
+
+
+class ScriptContext:
+    """Workspace scoped ``rollnw.script.Context`` shared across documents.
+
+    The underlying context caches every include it parses, so keeping one
+    alive means ``nwscript.nss`` and shared libraries are only parsed once.
+    rollnw offers no way to evict a single script from a context, so when an
+    include that has been loaded changes the whole context is dropped and
+    lazily rebuilt.  ``generation`` is bumped every time that happens so that
+    anything resolved against the old context can be recognized as stale.
+    Invalidation runs on the event loop, so the context is only marked there
+    and released by the next :meth:`get`, under the lock.
+
+    rollnw is not thread safe, any work on the context or on scripts resolved
+    against it must hold ``lock``.  The lock goes to the most urgent waiter
+    first, so background work releasing it between units of work yields to
+    interactive requests.  Contexts living in the same process must share one
+    lock, since rollnw's kernel is global to the process.
+    """
+
+    def __init__(self, lock: Optional[PriorityLock] = None):
+        self.lock = lock if lock is not None else PriorityLock()
+        self.generation = 0
+        self._ctx: Optional[rollnw.script.Context] = None
+        self._stale = False
+        self._paths: Set[str] = set()
+        self._loaded: Set[str] = set()
+
+    def get(self, paths: Iterable[str]) -> rollnw.script.Context:
+        """Gets the shared context, adding any include paths it lacks.
+
+        Must be called holding ``lock``.
+        """
+        if self._ctx is None or self._stale:
+            paths = list(paths)
+            self._paths = set(paths)
+            self._loaded = set()
+            self._stale = False
+            self._ctx = rollnw.script.Context(paths)
+            return self._ctx
+
+        for path in paths:
+            if path not in self._paths:
+                self._paths.add(path)
+                self._ctx.add_include_path(path)
+
+        return self._ctx
+
+    def call(self, fn: Callable[..., Any], *args) -> Any:
+        """Calls ``fn(*args)`` while holding the context lock."""
+        with self.lock:
+            return fn(*args)
+
+    def record_includes(self, nss: rollnw.script.Nss) -> Set[str]:
+        """Records the includes of ``nss`` as loaded into the context.
+
+        rollnw only reports the includes of a script itself, the scripts they
+        include in turn are looked up in the context, so the whole closure is
+        recorded and returned.  Must be called holding ``lock``.
+        """
+        result: Set[str] = set()
+        stack = list(nss.dependencies())
+        while stack:
+            name = stack.pop().lower()
+            if name in result:
+                continue
+            result.add(name)
+            include = self._ctx.get(name) if self._ctx is not None else None
+            if include is not None:
+                stack.extend(include.dependencies())
+
+        self._loaded.update(result)
+        return result
+
+    def invalidate(self, name: str) -> bool:
+        """Drops the context if the script ``name`` has been loaded into it."""
+        if self._ctx is None or self._stale:
+            return False
+
+        name = name.lower()
+        if name != "nwscript" and name not in self._loaded:
+            return False
+
+        self.reset()
+        return True
+
+    def reset(self):
+        """Marks the context to be dropped by the next :meth:`get`."""
+        self._stale = True
+        self.generation += 1
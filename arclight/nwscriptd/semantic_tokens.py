@@ -0,0 +1,125 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from lsprotocol import types as lsp
+
+TOKEN_TYPES = [
+    lsp.SemanticTokenTypes.Function,
+    lsp.SemanticTokenTypes.Variable,
+    lsp.SemanticTokenTypes.Parameter,
+    lsp.SemanticTokenTypes.Property,
+    lsp.SemanticTokenTypes.Struct,
+]
+
+TOKEN_MODIFIERS = [
+    lsp.SemanticTokenModifiers.Declaration,
+    lsp.SemanticTokenModifiers.Readonly,
+    lsp.SemanticTokenModifiers.DefaultLibrary,
+]
+
+LEGEND = lsp.SemanticTokensLegend(
+    token_types=[str(t.value) for t in TOKEN_TYPES],
+    token_modifiers=[str(m.value) for m in TOKEN_MODIFIERS],
+)
+
+
+def token_type(token_type: lsp.SemanticTokenTypes) -> int:
+    return TOKEN_TYPES.index(token_type)
+
+
+def token_modifiers(*modifiers: lsp.SemanticTokenModifiers) -> int:
+    result = 0
+    for modifier in modifiers:
+        result |= 1 << TOKEN_MODIFIERS.index(modifier)
+    return result
+
+
+class SemanticToken(NamedTuple):
+    line: int
+    start: int
+    length: int
+    type: int
+    modifiers: int = 0
+
+
+def encode(tokens: Iterable[SemanticToken]) -> List[int]:
+    """Encodes tokens, sorted by position, with the relative LSP encoding."""
+    data: List[int] = []
+    line = 0
+    start = 0
+    for token in tokens:
+        if token.line != line:
+            start = 0
+        data.extend((token.line - line, token.start - start, token.length,
+                     token.type, token.modifiers))
+        line = token.line
+        start = token.start
+    return data
+
+
+def diff(old: List[int], new: List[int]) -> List[lsp.SemanticTokensEdit]:
+    """Gets the edits turning ``old`` into ``new``.
+
+    Typing only changes the tokens around the cursor, so a single edit
+    replacing everything between the common prefix and suffix of both
+    sequences is all that is needed.  Edits are aligned to whole tokens.
+    """
+    if old == new:
+        return []
+
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    prefix -= prefix % 5
+
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    suffix -= suffix % 5
+
+    return [lsp.SemanticTokensEdit(
+        start=prefix,
+        delete_count=len(old) - prefix - suffix,
+        data=new[prefix:len(new) - suffix],
+    )]
+
+
+class SemanticTokensStore:
+    """The last semantic tokens sent for each document.
+
+    Tokens are kept with the document version they were computed for, so
+    that a repeated request is answered without recomputing them, and with
+    their result id, so that a delta against them can be sent next time.
+    """
+
+    def __init__(self):
+        self._next_id = 0
+        self._entries: Dict[str, Tuple[int, str, List[int]]] = {}
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._entries
+
+    def latest(self, uri: str, version: int) -> Optional[Tuple[str, List[int]]]:
+        """Gets the result id and tokens of ``uri`` if computed for ``version``."""
+        entry = self._entries.get(uri)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1], entry[2]
+
+    def get(self, uri: str, result_id: str) -> Optional[List[int]]:
+        """Gets the tokens sent for ``uri`` with ``result_id``."""
+        entry = self._entries.get(uri)
+        if entry is None or entry[1] != result_id:
+            return None
+        return entry[2]
+
+    def put(self, uri: str, version: int, data: List[int]) -> str:
+        """Stores the tokens sent for ``uri`` and returns their new result id."""
+        self._next_id += 1
+        result_id = str(self._next_id)
+        self._entries[uri] = (version, result_id, data)
+        return result_id
+
+    def remove(self, uri: str):
+        self._entries.pop(uri, None)
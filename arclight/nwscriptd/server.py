@@ -1,38 +1,352 @@
 import argparse
 import asyncio
+import copy
 import json
 import glob
+import logging
 import re
 import time
 import uuid
 import os
 import rollnw
-from typing import Optional, List
+from concurrent.futures.process import BrokenProcessPool
+from importlib import metadata
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, List, Set, Tuple, Union
 
 from lsprotocol import types as lsp
 
 from pygls.capabilities import get_capability
+from pygls.exceptions import JsonRpcContentModified, JsonRpcInternalError
+from pygls.protocol import LanguageServerProtocol, lsp_method
 from pygls.server import LanguageServer
+from pygls.uris import from_fs_path, to_fs_path
+
+from . import markup, preindex, semantic_tokens
+from .analysis import (CONVERTER, convert_range, document_symbols, index_script, parse_nss,
+                       read_script, reference_key, resolve_identifiers, scan_references)
+from .completion_cache import CompletionItemCache
+from .debounce import Debouncer
+from .dependencies import DependencyGraph
+from .fuzzy import fuzzy_rank
+from .diagnostics import DiagnosticReports, make_result_id
+from .documents import DocumentCache
+from .include_paths import IncludePathIndex
+from .inlay_hints import InlayHintCache
+from .kernel import KernelLoader
+from .recorder import SessionRecorder
+from .reference_index import ReferenceIndex, SymbolKey
+from .scheduler import BACKGROUND, DIAGNOSTICS, priority
+from .script_context import ScriptContext, script_name
+from .stats import Stats, process_memory
+from .symbol_cache import SymbolCache, changed_scripts, content_hash
+from .symbol_index import SymbolIndex
+from .text_document import LineIndexedWorkspace
+from .workers import CancellationToken, Cancelled, WorkerPool
+from .workspace_state import WorkspaceState
+
+if TYPE_CHECKING:
+    from .daemon import Daemon
+
+
+logger = logging.getLogger(__name__)
+
+
+class NWScriptLanguageServerProtocol(LanguageServerProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._request_starts: Dict[Any, Tuple[str, float]] = {}
+        self._notification_start: Optional[Tuple[str, float]] = None
+
+    def _handle_request(self, msg_id, method_name, params):
+        self._request_starts[msg_id] = (method_name, time.perf_counter())
+        super()._handle_request(msg_id, method_name, params)
+
+    def _handle_notification(self, method_name, params):
+        self._notification_start = (method_name, time.perf_counter())
+        try:
+            super()._handle_notification(method_name, params)
+        finally:
+            self._notification_start = None
+
+    def _execute_notification(self, handler, *params):
+        start = self._notification_start
+        if start is None or not asyncio.iscoroutinefunction(handler):
+            super()._execute_notification(handler, *params)
+            if start is not None:
+                self._record_method(start)
+            return
+
+        # Notifications such as didOpen are timed until their handler is done
+        future = asyncio.ensure_future(handler(*params))
+        future.add_done_callback(self._execute_notification_callback)
+        future.add_done_callback(lambda _: self._record_method(start))
+
+    def _record_method(self, start: Tuple[str, float]):
+        self._server.stats.record("method", start[0], time.perf_counter() - start[1])
+
+    def _execute_request_callback(self, msg_id, future):
+        # Work abandoned because the document was edited, the client is
+        # expected to ask again for the current version
+        if not future.cancelled() and isinstance(future.exception(), Cancelled):
+            self._request_futures.pop(msg_id, None)
+            self._send_response(msg_id, error=JsonRpcContentModified(
+                f'Request with id "{msg_id}" is outdated').to_response_error())
+            return
+        super()._execute_request_callback(msg_id, future)
+
+    def _send_response(self, msg_id, result=None, error=None):
+        # Responses are timed once sent, so that serialization is included
+        super()._send_response(msg_id, result, error)
+        start = self._request_starts.pop(msg_id, None)
+        if start is not None:
+            self._record_method(start)
+
+    def _send_data(self, data):
+        if not data or self.transport is None:
+            super()._send_data(data)
+            return
+
+        # As the base class does, with serialization and the write to the
+        # transport timed apart
+        try:
+            with self._server.stats.timer("phase", "serialize"):
+                body = json.dumps(data, default=self._serialize_message)
+            logger.info("Sending data: %s", body)
+
+            with self._server.stats.timer("phase", "write"):
+                if self._send_only_body:
+                    self.transport.write(body)
+                else:
+                    header = (
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Content-Type: {self.CONTENT_TYPE}; charset={self.CHARSET}\r\n\r\n"
+                    ).encode(self.CHARSET)
+                    self.transport.write(header + body.encode(self.CHARSET))
+        except Exception as error:
+            logger.exception("Error sending data", exc_info=True)
+            self._server._report_server_error(error, JsonRpcInternalError)
+            return
+
+        recorder = self._server.recorder
+        if recorder is not None:
+            recorder.record("out", body)
+
+    def connection_lost(self, exc):
+        # A daemon keeps serving its other clients
+        daemon = self._server.daemon
+        if daemon is None:
+            super().connection_lost(exc)
+        else:
+            daemon.disconnect(self._server)
+
+    def _deserialize_message(self, data):
+        # Nested objects pass through here too, only whole messages are recorded
+        recorder = self._server.recorder
+        if recorder is not None and "jsonrpc" in data:
+            recorder.record("in", json.dumps(data))
+        return super()._deserialize_message(data)
+
+    @lsp_method(lsp.INITIALIZE)
+    def lsp_initialize(self, params: lsp.InitializeParams) -> lsp.InitializeResult:
+        # Call the undecorated base so the user feature only runs once
+        result = LanguageServerProtocol.lsp_initialize.__wrapped__(self, params)
+
+        workspace = self._workspace
+        self._workspace = LineIndexedWorkspace(
+            workspace.root_uri,
+            self._server._text_document_sync_kind,
+            list(workspace.folders.values()),
+            workspace.position_encoding,
+        )
+        return result
+
+    @lsp_method(lsp.EXIT)
+    def lsp_exit(self, *args) -> None:
+        if self._server.daemon is None:
+            LanguageServerProtocol.lsp_exit.__wrapped__(self, *args)
+        elif self.transport is not None:
+            self.transport.close()
+
+
+def _workspace_attribute(name: str) -> property:
+    """Forwards a server attribute to its workspace state."""
+    return property(
+        lambda self: getattr(self.workspace_state, name),
+        lambda self, value: setattr(self.workspace_state, name, value),
+    )
 
-from . import markup
 
+class NWScriptLanguageServer(LanguageServer):
+    # The caches and indexes of the workspace, which a daemon shares between
+    # the clients that open it
+    include_paths = _workspace_attribute("include_paths")
+    script_context = _workspace_attribute("script_context")
+    dependencies = _workspace_attribute("dependencies")
+    symbol_cache = _workspace_attribute("symbol_cache")
+    symbol_cache_debouncer = _workspace_attribute("symbol_cache_debouncer")
+    symbol_index = _workspace_attribute("symbol_index")
+    reference_index = _workspace_attribute("reference_index")
+    stale_references = _workspace_attribute("stale_references")
+    completion_items = _workspace_attribute("completion_items")
+    markup_cache = _workspace_attribute("markup_cache")
+    cache_task = _workspace_attribute("cache_task")
+    index_task = _workspace_attribute("index_task")
+    preindex_task = _workspace_attribute("preindex_task")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._registrations: List[Tuple[str, tuple, dict, Callable]] = []
+        self.daemon: Optional["Daemon"] = None
+        self.workspace_root: Optional[str] = None
+        self.workspace_state = WorkspaceState(self.loop)
+        self.kernel = KernelLoader()
+        self.documents = DocumentCache()
+        self.diagnostics_debouncer = Debouncer(self.loop)
+        self.stats = Stats()
+        self.workers = WorkerPool(stats=self.stats)
+        self.diagnostic_reports = DiagnosticReports()
+        self.session_id = uuid.uuid4().hex
+        self.reference_debouncer = Debouncer(self.loop, delay=1.0)
+        self.completion_limit = 200
+        self.inlay_hints = InlayHintCache()
+        # Background work on each open document, cancelled when it closes
+        self.prefetch_tasks: Dict[str, Set[asyncio.Task]] = {}
+        self.semantic_tokens = semantic_tokens.SemanticTokensStore()
+        self.recorder: Optional[SessionRecorder] = None
+        self.preindex_processes = 0
+        self.completion_request: Optional[Tuple[int, str, lsp.Position]] = None
+
+    def feature(self, *args, **kwargs):
+        # Registrations are recorded so that spawned servers can repeat them
+        decorator = super().feature(*args, **kwargs)
+
+        def register(f):
+            self._registrations.append(("feature", args, kwargs, f))
+            return decorator(f)
+        return register
+
+    def command(self, *args):
+        decorator = super().command(*args)
+
+        def register(f):
+            self._registrations.append(("command", args, {}, f))
+            return decorator(f)
+        return register
+
+    def spawn(self) -> "NWScriptLanguageServer":
+        """Creates a server for another client on the same event loop.
+
+        The new server has the same features and shares the rollnw kernel,
+        worker pool and statistics, everything else is its own.  Its
+        workspace's script context uses this server's lock, rollnw must never
+        be entered by two clients at once, even when they work in different
+        workspaces.
+        """
+        server = type(self)(
+            self.name, self.version,
+            loop=self.loop,
+            protocol_cls=type(self.lsp),
+            text_document_sync_kind=self._text_document_sync_kind,
+        )
+        for method, args, kwargs, f in self._registrations:
+            getattr(server, method)(*args, **kwargs)(f)
+
+        server.workspace_state = WorkspaceState(server.loop, self.script_context.lock)
+        server.kernel = self.kernel
+        server.workers = self.workers
+        server.stats = self.stats
+        return server
+
+    def prefetch(self, uri: str, fn: Callable, *args):
+        """Runs ``fn(*args)`` in the background until ``uri`` is closed."""
+        task = self.loop.create_task(_background(fn, *args))
+        tasks = self.prefetch_tasks.setdefault(uri, set())
+        tasks.add(task)
+
+        def forget(task: asyncio.Task):
+            tasks.discard(task)
+            if not tasks and self.prefetch_tasks.get(uri) is tasks:
+                del self.prefetch_tasks[uri]
+
+        task.add_done_callback(forget)
+        return task
+
+    def cancel_prefetch(self, uri: Optional[str] = None):
+        """Cancels the background work on ``uri``, or on every document."""
+        uris = list(self.prefetch_tasks) if uri is None else [uri]
+        for uri in uris:
+            for task in self.prefetch_tasks.pop(uri, ()):
+                task.cancel()
+
+    def peers(self) -> List["NWScriptLanguageServer"]:
+        """Gets the servers of every client sharing this workspace, including this one."""
+        if self.daemon is None:
+            return [self]
+        return self.daemon.peers(self)
+
+    def memory(self) -> Dict[str, Any]:
+        """Reports the memory used by the process and the server's caches."""
+        return {
+            "process_bytes": process_memory(),
+            "documents": self.documents.memory(),
+            "symbol_index": len(self.symbol_index),
+            "reference_index": len(self.reference_index),
+            "symbol_cache": len(self.symbol_cache) if self.symbol_cache is not None else 0,
+            "completion_items": len(self.completion_items),
+            "markup": len(self.markup_cache),
+            "inlay_hints": len(self.inlay_hints),
+        }
+
+    def dump_stats(self, interval: float):
+        """Logs the latency statistics every ``interval`` seconds."""
+        logger.info("Latency stats: %s", json.dumps(self.stats.snapshot()))
+        logger.info("Worker queues: %s", json.dumps(self.workers.queue_depths()))
+        logger.info("Memory: %s", json.dumps(self.memory()))
+        self.loop.call_later(interval, self.dump_stats, interval)
+
+    def invalidate_script(self, path: str) -> List[Tuple["NWScriptLanguageServer", str]]:
+        """Drops cached state that depends on the script file at ``path``.
+
+        Returns the servers and URIs of open documents that include the
+        script, directly or indirectly, and so need to be revalidated.  In a
+        daemon that is the documents of every client sharing the workspace.
+        """
+        name = script_name(path)
+        context_dropped = self.script_context.invalidate(name)
+        self.dependencies.touch(name)
+        self.completion_items.remove(name)
+        self.markup_cache.invalidate(name)
+
+        if name == "nwscript":
+            affected = None
+        else:
+            affected = self.dependencies.transitive_dependents(name)
 
-def find_files_with_extension(start_path, file_extension, unique_paths=set()):
-    for root, dirs, files in os.walk(start_path):
-        for file in files:
-            if file.endswith(file_extension):
-                unique_paths.add(root)
-                break
+        result = []
+        for server in self.peers():
+            if context_dropped:
+                # Closed scripts were resolved against the dropped context
+                server.documents.clear_closed()
 
-    return list(unique_paths)
+            for uri, text_doc in server.workspace.text_documents.items():
+                if affected is None or script_name(text_doc.path) in affected:
+                    server.documents.remove(uri)
+                    server.inlay_hints.remove(uri)
+                    server.semantic_tokens.remove(uri)
+                    result.append((server, uri))
 
+        return result
 
-class NWScriptLanguageServer(LanguageServer):
-    def __init__(self, *args):
-        super().__init__(*args)
 
+WORKSPACE_SYMBOL_LIMIT = 256
+IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+PREFIX_RE = re.compile(r"[A-Za-z0-9_]*$")
 
-SERVER = NWScriptLanguageServer("nwscriptd", "v0.6.0")
+SERVER = NWScriptLanguageServer(
+    "nwscriptd", "v0.6.0",
+    protocol_cls=NWScriptLanguageServerProtocol,
+    text_document_sync_kind=lsp.TextDocumentSyncKind.Incremental,
+)
 
 
 def _choose_markup(server: NWScriptLanguageServer) -> lsp.MarkupKind:
@@ -46,14 +360,6 @@ def _choose_markup(server: NWScriptLanguageServer) -> lsp.MarkupKind:
     return markup_supported[0]
 
 
-def _convert_position(position: rollnw.script.SourcePosition) -> lsp.Position:
-    return lsp.Position(position.line - 1, position.column)
-
-
-def _convert_range(range: rollnw.script.SourceRange) -> lsp.Range:
-    return lsp.Range(_convert_position(range.start), _convert_position(range.end))
-
-
 def _convert_severity(severity: rollnw.script.DiagnosticSeverity) -> lsp.DiagnosticSeverity:
     if severity == rollnw.script.DiagnosticSeverity.error:
         return lsp.DiagnosticSeverity.Error
@@ -65,26 +371,329 @@ def _convert_severity(severity: rollnw.script.DiagnosticSeverity) -> lsp.Diagnos
         return lsp.DiagnosticSeverity.Information
 
 
-def _load_nss(uri) -> rollnw.script.Nss:
-    text_doc = SERVER.workspace.get_text_document(uri)
-    SERVER.show_message_log(f"Parsing nwscript file: {text_doc.filename}")
+def _include_paths(ls: NWScriptLanguageServer, path: str) -> List[str]:
+    paths = ls.include_paths.paths()
+    doc_dir = os.path.dirname(path)
+    if doc_dir not in ls.include_paths:
+        paths = [doc_dir] + paths
+    return paths
+
+
+def _check_version(ls: NWScriptLanguageServer, uri: str, version: Optional[int]):
+    """Raises :class:`Cancelled` if the document ``uri`` is no longer at ``version``."""
+    if ls.workspace.get_text_document(uri).version != version:
+        raise Cancelled()
+
+
+async def _load_nss(ls: NWScriptLanguageServer, uri: str):
+    """Gets the parsed script of ``uri`` at its current version.
+
+    Raises :class:`Cancelled` if the document is edited before the script
+    is ready, a request made against the old text has been outdated.
+    """
+    version = ls.workspace.get_text_document(uri).version
+
+    # Resolving scripts needs nwscript.nss from the kernel's resource manager
+    await ls.kernel.wait()
+    _check_version(ls, uri, version)
+
+    text_doc = ls.workspace.get_text_document(uri)
+    nss = ls.documents.get(uri, version)
+    if nss is not None:
+        return nss, text_doc
+
+    source = text_doc.source
+    digest = content_hash(source)
+
+    # An unchanged file that was closed and reopened, its includes and
+    # exports were recorded when it was first parsed.
+    nss = ls.documents.reopen(uri, digest)
+    if nss is not None:
+        ls.documents.put(uri, version, nss, digest, len(source))
+        return nss, text_doc
+
+    ls.show_message_log(f"Parsing nwscript file: {text_doc.filename}")
+
+    generation = ls.script_context.generation
+    token = CancellationToken()
+    nss, dependencies, symbols = await ls.workers.run_once(
+        ("parse", ls.session_id, uri, version, generation),
+        parse_nss,
+        ls.script_context,
+        ls.stats,
+        _include_paths(ls, text_doc.path),
+        source,
+        text_doc.filename == "nwscript.nss",
+        token,
+        token=token,
+    )
 
-    paths = find_files_with_extension(
-        SERVER.workspace.root_path, ".nss", set(os.path.dirname(text_doc.path)))
-    ctx = rollnw.script.Context(paths)
+    with ls.stats.timer("phase", "convert"):
+        exports = [CONVERTER.unstructure(symbol) for symbol in symbols]
+    ls.dependencies.set_includes(script_name(text_doc.path), dependencies)
+    ls.symbol_index.update(text_doc.path, exports)
+    if ls.symbol_cache is not None:
+        ls.symbol_cache.put(text_doc.path, digest, exports, dependencies)
+        ls.symbol_cache_debouncer.schedule("save", _background, _save_symbol_cache, ls)
 
-    nss = rollnw.script.Nss.from_string(
-        text_doc.source, ctx, text_doc.filename == "nwscript.nss")
-    nss.parse()
-    nss.process_includes()
-    nss.resolve()
+    # A script resolved against a context that has since been dropped is
+    # still fine to answer this request with, but must not be cached.
+    if generation == ls.script_context.generation:
+        ls.documents.put(uri, version, nss, digest, len(source))
 
+    _check_version(ls, uri, version)
     return nss, text_doc
 
 
-def _validate(ls, params):
-    nss, text_doc = _load_nss(params.text_document.uri)
+async def _save_symbol_cache(ls: NWScriptLanguageServer):
+    cache = ls.symbol_cache
+    if cache is None or not cache.dirty:
+        return
+    cache.stage()
+    await ls.workers.run(cache.flush)
+
+
+def _load_symbol_cache(ls: NWScriptLanguageServer, root_path: str):
+    """Loads the on-disk symbol cache and seeds the include graph from it."""
+    try:
+        rollnw_version = metadata.version("rollnw")
+    except metadata.PackageNotFoundError:
+        rollnw_version = "unknown"
+
+    ls.symbol_cache = SymbolCache(
+        root_path,
+        os.path.join(root_path, ".arclight", "nwscriptd-cache.jsonl"),
+        rollnw_version,
+    )
+    if not ls.symbol_cache.load():
+        return
+
+    for path, entry in ls.symbol_cache.items():
+        ls.dependencies.set_includes(script_name(path), entry["includes"])
+        ls.symbol_index.update(path, entry["exports"])
+
+    # Checking the cache against the scripts on disk reads all of them, so
+    # it is left to a worker and references are only trusted after it
+    ls.cache_task = ls.loop.create_task(_background(_verify_symbol_cache, ls))
+
+
+async def _verify_symbol_cache(ls: NWScriptLanguageServer):
+    """Drops cache entries of scripts changed on disk, then indexes the references of the rest."""
+    cache = ls.symbol_cache
+    changed = await ls.workers.run(changed_scripts, cache.hashes())
+    for path in cache.drop(changed):
+        ls.symbol_index.remove(path)
+    if changed:
+        ls.show_message_log(f"Dropped {len(changed)} symbol cache entries for scripts changed on disk")
+        ls.symbol_cache_debouncer.schedule("save", _background, _save_symbol_cache, ls)
+
+    for path, entry in cache.items():
+        # Scripts indexed in the meantime are already current
+        if "references" in entry and ls.reference_index.digest(path) is None:
+            ls.reference_index.update(path, entry["hash"], entry["references"])
+
+
+def _add_preindexed(ls: NWScriptLanguageServer, entry: Dict[str, Any]) -> bool:
+    """Feeds the summary of a script indexed by a pool process into the indexes."""
+    path = entry["path"]
+
+    # Open documents are indexed from their text in the editor instead
+    if any(text_doc.path == path for text_doc in ls.workspace.text_documents.values()):
+        return False
+
+    ls.dependencies.set_includes(script_name(path), entry["includes"])
+    ls.symbol_index.update(path, entry["exports"])
+    ls.reference_index.update(path, entry["hash"], entry["references"])
+    ls.stale_references.discard(path)
+    if ls.symbol_cache is not None:
+        ls.symbol_cache.put(path, entry["hash"], entry["exports"], entry["includes"])
+        ls.symbol_cache.set_references(path, entry["hash"], entry["references"])
+        ls.symbol_cache_debouncer.schedule("save", _background, _save_symbol_cache, ls)
+    return True
+
+
+async def _preindex_workspace(ls: NWScriptLanguageServer, processes: int):
+    """Parses and resolves every script in the workspace on a pool of processes.
+
+    Scripts whose content matches the reference index, e.g. loaded from the
+    symbol cache, are skipped by the pool processes without parsing.
+    """
+    paths = sorted(ls.include_paths.files())
+    if not paths:
+        return
+
+    token = None
+    if get_capability(ls.client_capabilities, "window.work_done_progress", False):
+        token = str(uuid.uuid4())
+        try:
+            await ls.progress.create_async(token)
+        except Exception:
+            token = None
+    if token is not None:
+        ls.progress.begin(token, lsp.WorkDoneProgressBegin(
+            title="Indexing scripts", percentage=0, cancellable=False))
+
+    loop = asyncio.get_running_loop()
+    pool = preindex.create_pool(
+        min(processes, len(paths)), ls.kernel.include_install, ls.kernel.include_user)
+    start = time.perf_counter()
+    indexed = 0
+    completed = 0
+    broken = False
+    try:
+        pending = {
+            loop.run_in_executor(
+                pool,
+                preindex.index_script,
+                path,
+                _include_paths(ls, path),
+                ls.reference_index.digest(path),
+            ): path
+            for path in paths
+        }
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                completed += 1
+                try:
+                    entry = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                except Exception as e:
+                    logger.warning("Failed to index %s: %s", path, e)
+                else:
+                    if entry is not None and _add_preindexed(ls, entry):
+                        indexed += 1
+
+            if token is not None:
+                ls.progress.report(token, lsp.WorkDoneProgressReport(
+                    message=f"{completed}/{len(paths)}",
+                    percentage=completed * 100 // len(paths)))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if token is not None:
+            ls.progress.end(token, lsp.WorkDoneProgressEnd(message=f"Indexed {indexed} scripts"))
+
+    if broken:
+        ls.show_message_log("Workspace indexing failed, the index processes could not start rollnw",
+                            lsp.MessageType.Warning)
+    else:
+        ls.show_message_log(f"Indexed {indexed} of {len(paths)} scripts in "
+                            f"{time.perf_counter() - start:.1f}s")
+
+
+async def _index_references(ls: NWScriptLanguageServer, uri: str):
+    """Brings the references of an open document in the reference index up to date."""
+    text_doc = ls.workspace.get_text_document(uri)
+    version = text_doc.version
+    source = text_doc.source
+    digest = content_hash(source)
+    if ls.reference_index.digest(text_doc.path) == digest:
+        ls.stale_references.discard(text_doc.path)
+        return
+
+    nss, text_doc = await _load_nss(ls, uri)
+    token = CancellationToken()
+    references = await ls.workers.run_once(
+        ("references", ls.session_id, uri, version),
+        scan_references,
+        ls.script_context,
+        _include_paths(ls, text_doc.path),
+        nss,
+        source,
+        script_name(text_doc.path),
+        token,
+        token=token,
+    )
+    _check_version(ls, uri, version)
+
+    ls.reference_index.update(text_doc.path, digest, references)
+    ls.stale_references.discard(text_doc.path)
+    if ls.symbol_cache is not None:
+        ls.symbol_cache.set_references(text_doc.path, digest, references)
+        ls.symbol_cache_debouncer.schedule("save", _background, _save_symbol_cache, ls)
+
+
+async def _index_file(ls: NWScriptLanguageServer, path: str):
+    """Brings the indexes of a script changed on disk up to date.
+
+    Open documents are indexed from their text in the editor instead.
+    """
+    for uri, text_doc in list(ls.workspace.text_documents.items()):
+        if text_doc.path == path:
+            await _index_references(ls, uri)
+            return
+
+    await ls.kernel.wait()
+    token = CancellationToken()
+    try:
+        entry = await ls.workers.run_once(
+            ("index", ls.session_id, path),
+            index_script,
+            ls.script_context,
+            ls.stats,
+            path,
+            _include_paths(ls, path),
+            ls.reference_index.digest(path),
+            token,
+            token=token,
+        )
+    except OSError:
+        # Deleted again before it was indexed, the watcher reports that too
+        return
+
+    if entry is None:
+        ls.stale_references.discard(path)
+    else:
+        _add_preindexed(ls, entry)
+
+
+async def _index_files(ls: NWScriptLanguageServer, paths: List[str]):
+    """Indexes scripts one after the other, e.g. those a rename is missing."""
+    for path in paths:
+        await _index_file(ls, path)
+
+
+def _unindexed_scripts(ls: NWScriptLanguageServer) -> List[str]:
+    """Gets the workspace scripts whose references are missing or outdated in the index."""
+    return [path for path in ls.include_paths.files()
+            if path in ls.stale_references or ls.reference_index.digest(path) is None]
+
+
+async def _background(fn: Callable[..., Any], *args):
+    """Runs ``fn(*args)`` at background priority, dropping it if it is outdated."""
+    try:
+        with priority(BACKGROUND):
+            await fn(*args)
+    except Cancelled:
+        pass
+
+
+def _cancel_outdated(ls: NWScriptLanguageServer, uri: str, version: int):
+    """Stops work on versions of ``uri`` older than ``version``.
+
+    Keys of work on a document are ``(kind, session_id, uri, version, ...)``,
+    the pool is shared by every client of a daemon and ``uri`` alone doesn't
+    tell their documents apart.
+    """
+    ls.workers.cancel(lambda key: key[1] == ls.session_id and key[2] == uri and key[3] != version)
 
+
+async def _query(ls: NWScriptLanguageServer, fn, *args):
+    """Runs ``fn(*args)`` on a worker thread holding the script context lock."""
+    return await ls.workers.run(ls.script_context.call, fn, *args)
+
+
+def _init_option(params: lsp.InitializeParams, name: str, default):
+    """Gets an initialization option sent by the client."""
+    options = params.initialization_options
+    if not isinstance(options, dict):
+        return default
+    return options.get(name, default)
+
+
+def _diagnostics(nss: rollnw.script.Nss) -> List[lsp.Diagnostic]:
     diagnostics = []
     error_lines = set()
     for diag in nss.diagnostics():
@@ -95,13 +704,145 @@ def _validate(ls, params):
                 error_lines.add(diag.location.start.line)
 
         d = lsp.Diagnostic(
-            range=_convert_range(diag.location),
+            range=convert_range(diag.location),
             message=diag.message,
             source=type(SERVER).__name__,
             severity=_convert_severity(diag.severity))
         diagnostics.append(d)
 
-    ls.publish_diagnostics(params.text_document.uri, diagnostics)
+    return diagnostics
+
+
+def _script_result_id(ls: NWScriptLanguageServer, name: str, source: str) -> str:
+    """Gets the result id of a diagnostic report for ``source`` of the resolved script ``name``."""
+    fingerprint = "{};nwscript@{}".format(
+        ls.dependencies.fingerprint(name), ls.dependencies.revision("nwscript"))
+    return make_result_id(ls.session_id, source, fingerprint)
+
+
+async def _diagnostic_result_id(ls: NWScriptLanguageServer, uri: str) -> str:
+    """Gets the result id a diagnostic report for the current text of ``uri`` would have."""
+    text_doc = ls.workspace.get_text_document(uri)
+    name = script_name(text_doc.path)
+
+    # The includes of a script are only known once it has been resolved
+    if name not in ls.dependencies:
+        with priority(DIAGNOSTICS):
+            await _load_nss(ls, uri)
+
+    return _script_result_id(ls, name, text_doc.source)
+
+
+async def _document_diagnostics(ls: NWScriptLanguageServer, uri: str) -> Tuple[str, List[lsp.Diagnostic]]:
+    """Gets the diagnostics of a document and their result id.
+
+    Diagnostics are only recomputed if the document or one of its includes
+    changed since they were last computed.
+    """
+    version = ls.workspace.get_text_document(uri).version
+    result_id = await _diagnostic_result_id(ls, uri)
+    diagnostics = ls.diagnostic_reports.get(uri, result_id)
+    if diagnostics is not None:
+        return result_id, diagnostics
+
+    with priority(DIAGNOSTICS):
+        nss, text_doc = await _load_nss(ls, uri)
+        diagnostics = await _query(ls, _diagnostics, nss)
+    if ls.workspace.get_text_document(uri).version == version:
+        ls.diagnostic_reports.put(uri, result_id, diagnostics)
+
+    return result_id, diagnostics
+
+
+def _closed_script_diagnostics(script_context: ScriptContext, stats: Stats, path: str,
+                               include_paths: List[str], source: str,
+                               cancel: CancellationToken) -> List[lsp.Diagnostic]:
+    """Parses and resolves a script that isn't open.  Runs on a worker thread."""
+    nss, _, _ = parse_nss(script_context, stats, include_paths, source,
+                          script_name(path) == "nwscript", cancel)
+    return script_context.call(_diagnostics, nss)
+
+
+async def _closed_script_report(ls: NWScriptLanguageServer, path: str, previous: Dict[str, str]
+                                ) -> Optional[lsp.WorkspaceDocumentDiagnosticReport]:
+    """Gets the workspace diagnostic report of a script as it is on disk.
+
+    The script is only parsed if it or one of its includes changed since
+    its diagnostics were last computed.
+    """
+    uri = from_fs_path(path)
+    try:
+        source = await ls.workers.run(read_script, path)
+    except OSError:
+        return None
+
+    result_id = _script_result_id(ls, script_name(path), source)
+    if previous.get(uri) == result_id:
+        return lsp.WorkspaceUnchangedDocumentDiagnosticReport(
+            uri=uri, version=None, result_id=result_id)
+
+    diagnostics = ls.diagnostic_reports.get(uri, result_id)
+    if diagnostics is None:
+        await ls.kernel.wait()
+        token = CancellationToken()
+        with priority(BACKGROUND):
+            diagnostics = await ls.workers.run_once(
+                ("diagnostics", ls.session_id, uri, result_id),
+                _closed_script_diagnostics,
+                ls.script_context,
+                ls.stats,
+                path,
+                _include_paths(ls, path),
+                source,
+                token,
+                token=token,
+            )
+        ls.diagnostic_reports.put(uri, result_id, diagnostics)
+
+    return lsp.WorkspaceFullDocumentDiagnosticReport(
+        uri=uri, version=None, items=diagnostics, result_id=result_id)
+
+
+def _supports_pull_diagnostics(ls: NWScriptLanguageServer) -> bool:
+    return get_capability(ls.client_capabilities, "text_document.diagnostic") is not None
+
+
+async def _validate(ls, uri):
+    version = ls.workspace.get_text_document(uri).version
+    try:
+        result_id, diagnostics = await _document_diagnostics(ls, uri)
+    except Cancelled:
+        return
+
+    # Drop results for a document that has been edited in the meantime
+    if ls.workspace.get_text_document(uri).version != version:
+        return
+
+    # Clients that pull diagnostics only need the report to be warmed up
+    if _supports_pull_diagnostics(ls):
+        return
+
+    ls.publish_diagnostics(uri, diagnostics, version)
+
+
+def _supports_diagnostic_refresh(ls: NWScriptLanguageServer) -> bool:
+    return get_capability(ls.client_capabilities, "workspace.diagnostics.refresh_support", False)
+
+
+def _refresh_diagnostics(ls: NWScriptLanguageServer):
+    ls.lsp.send_request(lsp.WORKSPACE_DIAGNOSTIC_REFRESH)
+
+
+def _revalidate(documents: List[Tuple[NWScriptLanguageServer, str]]):
+    """Schedules validation of open documents affected by an include change.
+
+    Clients that pull diagnostics don't know the reports changed, they are
+    asked to pull again once per burst of changes if they support it.
+    """
+    for ls, uri in documents:
+        ls.diagnostics_debouncer.schedule(uri, _validate, ls, uri)
+        if _supports_pull_diagnostics(ls) and _supports_diagnostic_refresh(ls):
+            ls.diagnostics_debouncer.schedule("refresh", _refresh_diagnostics, ls)
 
 
 def log_to_output(
@@ -113,64 +854,138 @@ def log_to_output(
 @SERVER.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
 async def did_open(ls, params: lsp.DidOpenTextDocumentParams):
     """Text document did open notification."""
-    _validate(ls, params)
+    ls.diagnostics_debouncer.cancel(params.text_document.uri)
+    await _validate(ls, params.text_document.uri)
+    ls.reference_debouncer.schedule(
+        params.text_document.uri, _background, _index_references, ls, params.text_document.uri)
 
 
 @SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
 def did_change(ls, params: lsp.DidChangeTextDocumentParams):
     """Text document did change notification."""
-    _validate(ls, params)
+    uri = params.text_document.uri
+    _cancel_outdated(ls, uri, params.text_document.version)
+    ls.diagnostics_debouncer.schedule(uri, _validate, ls, uri)
+    ls.reference_debouncer.schedule(uri, _background, _index_references, ls, uri)
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_DID_SAVE)
+def did_save(ls: NWScriptLanguageServer, params: lsp.DidSaveTextDocumentParams):
+    """Text document did save notification."""
+    path = to_fs_path(params.text_document.uri)
+    if path is not None:
+        _revalidate(ls.invalidate_script(path))
 
 
 @SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
 def did_close(server: NWScriptLanguageServer, params: lsp.DidCloseTextDocumentParams):
     """Text document did close notification."""
+    server.diagnostics_debouncer.cancel(params.text_document.uri)
+    server.reference_debouncer.cancel(params.text_document.uri)
+    server.cancel_prefetch(params.text_document.uri)
+    server.documents.close(params.text_document.uri)
+    server.inlay_hints.remove(params.text_document.uri)
+    server.semantic_tokens.remove(params.text_document.uri)
+    server.diagnostic_reports.remove(params.text_document.uri)
     server.show_message("Text Document Did Close")
 
 
-def _symbol_to_doc_symbol(script, symbol):
-    name = symbol.decl.identifier()
-    range = symbol.decl.range()
-    selection_range = symbol.decl.selection_range()
-
-    if isinstance(symbol.decl, rollnw.script.VarDecl):
-        kind = lsp.SymbolKind.Variable
-        detail = "(variable)"
-    elif isinstance(symbol.decl, rollnw.script.FunctionDefinition):
-        kind = lsp.SymbolKind.Function
-        detail = "(function)"
-    elif isinstance(symbol.decl, rollnw.script.FunctionDecl):
-        kind = lsp.SymbolKind.Function
-        detail = "(function)"
-    elif isinstance(symbol.decl, rollnw.script.StructDecl):
-        kind = lsp.SymbolKind.Struct
-        detail = "(struct)"
-
-    return lsp.DocumentSymbol(name=name,
-                              kind=kind,
-                              range=_convert_range(range),
-                              selection_range=_convert_range(selection_range),
-                              detail=detail)
-
-
 @SERVER.feature(
     lsp.TEXT_DOCUMENT_DOCUMENT_SYMBOL,
     lsp.DocumentSymbolOptions()
 )
-def text_document_document_symbol(
-    server: NWScriptLanguageServer,
+async def text_document_document_symbol(
+    ls: NWScriptLanguageServer,
     params: lsp.DocumentSymbolParams
-) -> [lsp.DocumentSymbol]:
-    nss, text_doc = _load_nss(params.text_document.uri)
-    result = [_symbol_to_doc_symbol(nss, symbol) for symbol in nss.exports()]
+) -> List[lsp.DocumentSymbol]:
+    uri = params.text_document.uri
+    text_doc = ls.workspace.get_text_document(uri)
+
+    # Until the document is resolved answer from the on-disk cache if its
+    # entry is still current.
+    if ls.symbol_cache is not None and ls.documents.get(uri, text_doc.version) is None:
+        entry = ls.symbol_cache.get(text_doc.path, content_hash(text_doc.source))
+        if entry is not None:
+            return [CONVERTER.structure(symbol, lsp.DocumentSymbol)
+                    for symbol in entry["exports"]]
+
+    nss, text_doc = await _load_nss(ls, uri)
+    return await _query(ls, document_symbols, nss)
+
+
+@SERVER.feature(lsp.WORKSPACE_SYMBOL)
+def workspace_symbol(ls: NWScriptLanguageServer,
+                     params: lsp.WorkspaceSymbolParams) -> List[lsp.SymbolInformation]:
+    """Searches the exports of every indexed script, no script is parsed."""
+    result = []
+    for symbol in ls.symbol_index.search(params.query, WORKSPACE_SYMBOL_LIMIT):
+        result.append(lsp.SymbolInformation(
+            name=symbol.name,
+            kind=lsp.SymbolKind(symbol.kind),
+            location=lsp.Location(
+                from_fs_path(symbol.path),
+                CONVERTER.structure(symbol.range, lsp.Range),
+            ),
+        ))
     return result
 
 
-@SERVER.feature(lsp.TEXT_DOCUMENT_DIAGNOSTIC)
-def text_document_diagnostic(params: lsp.DiagnosticOptions):
+@SERVER.feature(
+    lsp.TEXT_DOCUMENT_DIAGNOSTIC,
+    lsp.DiagnosticOptions(
+        identifier="nwscriptd",
+        inter_file_dependencies=True,
+        workspace_diagnostics=True,
+    ),
+)
+async def text_document_diagnostic(ls: NWScriptLanguageServer,
+                                   params: lsp.DocumentDiagnosticParams) -> lsp.DocumentDiagnosticReport:
     """Returns diagnostic report."""
+    uri = params.text_document.uri
+    if params.previous_result_id is not None:
+        result_id = await _diagnostic_result_id(ls, uri)
+        if result_id == params.previous_result_id:
+            return lsp.RelatedUnchangedDocumentDiagnosticReport(result_id=result_id)
+
+    result_id, diagnostics = await _document_diagnostics(ls, uri)
+    return lsp.RelatedFullDocumentDiagnosticReport(items=diagnostics, result_id=result_id)
 
-    _validate(SERVER, params)
+
+@SERVER.feature(lsp.WORKSPACE_DIAGNOSTIC)
+async def workspace_diagnostic(ls: NWScriptLanguageServer,
+                               params: lsp.WorkspaceDiagnosticParams) -> lsp.WorkspaceDiagnosticReport:
+    """Returns diagnostic reports for open documents and every indexed workspace script.
+
+    Scripts that aren't open are reported as they are on disk, once their
+    includes are known from the workspace index.
+    """
+    previous = {p.uri: p.value for p in params.previous_result_ids}
+    text_docs = list(ls.workspace.text_documents.items())
+    open_paths = {text_doc.path for _, text_doc in text_docs}
+
+    items = []
+    for uri, text_doc in text_docs:
+        result_id = await _diagnostic_result_id(ls, uri)
+        if previous.get(uri) == result_id:
+            items.append(lsp.WorkspaceUnchangedDocumentDiagnosticReport(
+                uri=uri, version=text_doc.version, result_id=result_id))
+            continue
+
+        result_id, diagnostics = await _document_diagnostics(ls, uri)
+        items.append(lsp.WorkspaceFullDocumentDiagnosticReport(
+            uri=uri, version=text_doc.version, items=diagnostics, result_id=result_id))
+
+    for path in sorted(ls.include_paths.files()):
+        if path in open_paths or script_name(path) not in ls.dependencies:
+            continue
+        try:
+            report = await _closed_script_report(ls, path, previous)
+        except Cancelled:
+            continue
+        if report is not None:
+            items.append(report)
+
+    return lsp.WorkspaceDiagnosticReport(items=items)
 
 
 def _function_to_snippet(script, function):
@@ -221,77 +1036,201 @@ def _symbol_to_completion_item(script, symbol):
                                   detail=detail)
 
 
+def _provider_completion_items(ls: NWScriptLanguageServer,
+                               provider: rollnw.script.Nss) -> List[lsp.CompletionItem]:
+    """Gets the prebuilt completion items for the exports of an include."""
+    name = script_name(provider.name())
+    revision = ls.dependencies.revision(name)
+    items = ls.completion_items.get(name, revision)
+    if items is None:
+        items = [_symbol_to_completion_item(provider, symbol) for symbol in provider.exports()]
+        ls.completion_items.put(name, revision, items)
+    return items
+
+
+def _complete(ls: NWScriptLanguageServer, nss: rollnw.script.Nss, line: str, needle: str,
+              position: lsp.Position) -> List[lsp.CompletionItem]:
+    if line[position.character-1] == ".":
+        nl = line[:position.character-1]
+        word = nl.split()[-1]
+        character = line.find(word)
+        completions = nss.complete_dot(
+            word, position.line + 1, character, True)
+        return [_symbol_to_completion_item(nss, item) for item in completions]
+
+    completions = nss.complete_at(
+        needle, position.line + 1, position.character, True)
+
+    # Only symbols local to the script are converted on every request, the
+    # items of each include are built once per revision.
+    items = []
+    providers = set()
+    for item in completions:
+        provider = item.provider
+        if provider is None:
+            items.append(_symbol_to_completion_item(nss, item))
+            continue
+
+        name = provider.name()
+        if name not in providers:
+            providers.add(name)
+            items.extend(_provider_completion_items(ls, provider))
+
+    return items
+
+
+def _rank_completions(items: List[lsp.CompletionItem], prefix: str, limit: int,
+                      data: Optional[int] = None) -> Tuple[List[lsp.CompletionItem], bool]:
+    """Ranks completion items against ``prefix`` and caps them at ``limit``.
+
+    Returns the items and whether any were dropped.  Items are copied before
+    their sort text and resolve ``data`` are set, since the items of includes
+    are shared.
+    """
+    ranked = fuzzy_rank(prefix, items, key=lambda item: item.filter_text or item.label,
+                        limit=limit + 1)
+    truncated = len(ranked) > limit
+
+    result = []
+    for i, item in enumerate(ranked[:limit]):
+        item = copy.copy(item)
+        item.sort_text = f"{i:05d}"
+        item.data = data
+        result.append(item)
+
+    return result, truncated
+
+
 @SERVER.feature(
     lsp.TEXT_DOCUMENT_COMPLETION,
-    lsp.CompletionOptions(trigger_characters=["."]),
+    lsp.CompletionOptions(trigger_characters=["."], resolve_provider=True),
 )
-def completions(params: Optional[lsp.CompletionParams] = None) -> lsp.CompletionList:
+async def completions(ls: NWScriptLanguageServer,
+                      params: Optional[lsp.CompletionParams] = None) -> lsp.CompletionList:
     """Returns completion items."""
 
     if params is None:
         return lsp.CompletionList(is_incomplete=False, items=[])
 
-    nss, text_doc = _load_nss(params.text_document.uri)
+    nss, text_doc = await _load_nss(ls, params.text_document.uri)
 
-    items = []
     needle = text_doc.word_at_position(params.position)
+    line = text_doc.lines[params.position.line]
+    items = await _query(ls, _complete, ls, nss, line, needle, params.position)
 
-    if text_doc.lines[params.position.line][params.position.character-1] == ".":
-        nl = text_doc.lines[params.position.line][:params.position.character-1]
-        word = nl.split()[-1]
-        character = text_doc.lines[params.position.line].find(word)
-        completions = nss.complete_dot(
-            word, params.position.line + 1, character, True)
-    else:
-        completions = nss.complete_at(
-            needle, params.position.line + 1, params.position.character, True)
+    # Rank on the typed prefix, the client re-queries as it grows if the
+    # list has been truncated.
+    prefix = PREFIX_RE.search(line[:params.position.character]).group()
+
+    # Items only carry the request id, documentation is looked up on resolve
+    # from the position they were completed at.
+    request_id = ls.completion_request[0] + 1 if ls.completion_request else 0
+    ls.completion_request = (request_id, params.text_document.uri, params.position)
 
-    SERVER.show_message_log(str(len(completions)))
-    items = [_symbol_to_completion_item(nss, item) for item in completions]
+    items, truncated = await ls.workers.run(
+        _rank_completions, items, prefix, ls.completion_limit, request_id)
 
     return lsp.CompletionList(
-        is_incomplete=False,
+        is_incomplete=truncated,
         items=items
     )
 
 
-@SERVER.feature(lsp.TEXT_DOCUMENT_HOVER)
-def text_document_hover(server: NWScriptLanguageServer, params: lsp.HoverParams) -> Optional[lsp.Hover]:
-    nss, text_doc = _load_nss(params.text_document.uri)
+def _render_markup(nss: rollnw.script.Nss, symbol: rollnw.script.Symbol,
+                   markup_kind: lsp.MarkupKind) -> Optional[lsp.MarkupContent]:
+    if isinstance(symbol.decl, rollnw.script.VarDecl):
+        return markup.hover_var_decl(symbol, markup_kind)
+    elif isinstance(symbol.decl, rollnw.script.FunctionDecl):
+        return markup.hover_func_decl(nss, symbol, markup_kind)
+    elif isinstance(symbol.decl, rollnw.script.FunctionDefinition):
+        return markup.hover_func_decl(nss, symbol, markup_kind)
+    elif isinstance(symbol.decl, rollnw.script.StructDecl):
+        return markup.hover_struct_decl(nss, symbol, markup_kind)
+    else:
+        return
 
-    needle = text_doc.word_at_position(params.position)
+
+def _symbol_markup(ls: NWScriptLanguageServer, nss: rollnw.script.Nss, symbol: rollnw.script.Symbol,
+                   markup_kind: lsp.MarkupKind) -> Optional[lsp.MarkupContent]:
+    """Renders the markup of a declaration, cached if it comes from an include.
+
+    Declarations local to the script are rendered every time, they move with
+    every edit.
+    """
+    if symbol.provider is None:
+        return _render_markup(nss, symbol, markup_kind)
+
+    provider = script_name(symbol.provider.name())
+    start = symbol.decl.selection_range().start
+    key = (provider, ls.dependencies.revision(provider), symbol.decl.identifier(),
+           start.line, start.column, markup_kind)
+    contents = ls.markup_cache.get(key)
+    if contents is None:
+        contents = _render_markup(nss, symbol, markup_kind)
+        if contents is not None:
+            ls.markup_cache.put(key, contents)
+    return contents
+
+
+def _hover(ls: NWScriptLanguageServer, nss: rollnw.script.Nss, needle: str,
+           position: lsp.Position, markup_kind: lsp.MarkupKind) -> Optional[lsp.Hover]:
     decl_info = nss.locate_symbol(
-        needle, params.position.line + 1, params.position.character)
+        needle, position.line + 1, position.character)
 
     if decl_info.decl is None:
         return
 
-    markup_kind = _choose_markup(server)
-    if isinstance(decl_info.decl, rollnw.script.VarDecl):
-        return lsp.Hover(markup.hover_var_decl(decl_info, markup_kind))
-    elif isinstance(decl_info.decl, rollnw.script.FunctionDecl):
-        return lsp.Hover(markup.hover_func_decl(nss, decl_info, markup_kind))
-    elif isinstance(decl_info.decl, rollnw.script.FunctionDefinition):
-        return lsp.Hover(markup.hover_func_decl(nss, decl_info, markup_kind))
-    elif isinstance(decl_info.decl, rollnw.script.StructDecl):
-        return lsp.Hover(markup.hover_struct_decl(nss, decl_info, markup_kind))
-    else:
+    contents = _symbol_markup(ls, nss, decl_info, markup_kind)
+    if contents is None:
         return
+    return lsp.Hover(contents)
 
 
-@SERVER.feature(lsp.TEXT_DOCUMENT_INLAY_HINT)
-def inlay_hint(params: lsp.InlayHintParams) -> List[lsp.InlayHint]:
-    nss, text_doc = _load_nss(params.text_document.uri)
+@SERVER.feature(lsp.TEXT_DOCUMENT_HOVER)
+async def text_document_hover(ls: NWScriptLanguageServer, params: lsp.HoverParams) -> Optional[lsp.Hover]:
+    nss, text_doc = await _load_nss(ls, params.text_document.uri)
+
+    needle = text_doc.word_at_position(params.position)
+    return await _query(ls, _hover, ls, nss, needle, params.position, _choose_markup(ls))
+
+
+def _completion_documentation(ls: NWScriptLanguageServer, nss: rollnw.script.Nss,
+                              item: lsp.CompletionItem, position: lsp.Position,
+                              markup_kind: lsp.MarkupKind) -> Optional[lsp.MarkupContent]:
+    symbol = nss.locate_symbol(item.label, position.line + 1, position.character)
+    if symbol.decl is None:
+        symbol = nss.locate_export(item.label, item.kind == lsp.CompletionItemKind.Struct, True)
+    if symbol.decl is None:
+        return
+    return _symbol_markup(ls, nss, symbol, markup_kind)
+
 
+@SERVER.feature(lsp.COMPLETION_ITEM_RESOLVE)
+async def completion_item_resolve(ls: NWScriptLanguageServer,
+                                  item: lsp.CompletionItem) -> lsp.CompletionItem:
+    """Adds documentation to the completion item the user highlighted."""
+    request = ls.completion_request
+    if request is None or item.data != request[0] or item.documentation is not None:
+        return item
+
+    _, uri, position = request
+    if uri not in ls.workspace.text_documents:
+        return item
+
+    nss, text_doc = await _load_nss(ls, uri)
+    item.documentation = await _query(
+        ls, _completion_documentation, ls, nss, item, position, _choose_markup(ls))
+    return item
+
+
+def _inlay_hints(nss: rollnw.script.Nss, range: lsp.Range) -> List[lsp.InlayHint]:
     src_range = rollnw.script.SourceRange()
-    src_range.start.line = params.range.start.line + 1
-    src_range.start.column = params.range.start.character
-    src_range.end.line = params.range.end.line + 1
-    src_range.end.column = params.range.end.character
+    src_range.start.line = range.start.line + 1
+    src_range.start.column = range.start.character
+    src_range.end.line = range.end.line + 1
+    src_range.end.column = range.end.character
     hints = nss.inlay_hints(src_range)
 
-    log_to_output(str(len(hints)))
-
     result = []
     for hint in hints:
         result.append(lsp.InlayHint(lsp.Position(
@@ -300,19 +1239,176 @@ def inlay_hint(params: lsp.InlayHintParams) -> List[lsp.InlayHint]:
     return result
 
 
-@SERVER.feature(lsp.TEXT_DOCUMENT_SIGNATURE_HELP,
-                lsp.SignatureHelpOptions(trigger_characters=["(", ","]))
-def text_document_signature_help(params: lsp.SignatureHelpParams) -> Optional[lsp.SignatureHelp]:
-    nss, text_doc = _load_nss(params.text_document.uri)
+async def _compute_inlay_hints(ls: NWScriptLanguageServer, uri: str, version: int,
+                               nss: rollnw.script.Nss, chunks: List[int]):
+    for chunk in chunks:
+        hints = await ls.workers.run_once(
+            ("inlay_hints", ls.session_id, uri, version, chunk),
+            ls.script_context.call,
+            _inlay_hints,
+            nss,
+            ls.inlay_hints.chunk_range(chunk),
+        )
+        if ls.workspace.get_text_document(uri).version != version:
+            return
+        ls.inlay_hints.put(uri, version, chunk, hints)
+
+
+async def _prefetch_inlay_hints(ls: NWScriptLanguageServer, uri: str, version: int,
+                                nss: rollnw.script.Nss, start_line: int, end_line: int):
+    """Computes the chunks either side of a requested range, ready for scrolling."""
+    if uri not in ls.workspace.text_documents:
+        return
+
+    line_count = len(ls.workspace.get_text_document(uri).lines)
+    start_line = max(start_line - ls.inlay_hints.chunk_lines, 0)
+    end_line = min(end_line + ls.inlay_hints.chunk_lines, max(line_count - 1, 0))
+    await _compute_inlay_hints(
+        ls, uri, version, nss, ls.inlay_hints.missing(uri, version, start_line, end_line))
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_INLAY_HINT)
+async def inlay_hint(ls: NWScriptLanguageServer, params: lsp.InlayHintParams) -> List[lsp.InlayHint]:
+    uri = params.text_document.uri
+    nss, text_doc = await _load_nss(ls, uri)
+    version = text_doc.version
+    start_line = params.range.start.line
+    end_line = params.range.end.line
+
+    # Hints are computed per chunk of lines and sliced to the requested range
+    await _compute_inlay_hints(
+        ls, uri, version, nss, ls.inlay_hints.missing(uri, version, start_line, end_line))
+
+    result = ls.inlay_hints.get(uri, version, params.range)
+    if result is None:
+        # The document changed while hints were computed
+        result = await _query(ls, _inlay_hints, nss, params.range)
+    else:
+        ls.prefetch(uri, _prefetch_inlay_hints, ls, uri, version, nss, start_line, end_line)
+
+    return result
+
+
+def _is_const(decl: rollnw.script.VarDecl) -> bool:
+    qualifier = decl.type.type_qualifier
+    return getattr(qualifier, "type", None) == rollnw.script.NssTokenType.CONST
+
+
+def _semantic_token(token: rollnw.script.NssToken,
+                    symbol: rollnw.script.Symbol) -> Optional[semantic_tokens.SemanticToken]:
+    if symbol.decl is None:
+        return None
+
+    modifiers = []
+    if symbol.kind == rollnw.script.SymbolKind.function:
+        token_type = lsp.SemanticTokenTypes.Function
+    elif symbol.kind == rollnw.script.SymbolKind.type:
+        token_type = lsp.SemanticTokenTypes.Struct
+    elif symbol.kind == rollnw.script.SymbolKind.field:
+        token_type = lsp.SemanticTokenTypes.Property
+    elif symbol.kind == rollnw.script.SymbolKind.param:
+        token_type = lsp.SemanticTokenTypes.Parameter
+    else:
+        token_type = lsp.SemanticTokenTypes.Variable
+        if isinstance(symbol.decl, rollnw.script.VarDecl) and _is_const(symbol.decl):
+            modifiers.append(lsp.SemanticTokenModifiers.Readonly)
+
+    start = token.loc.range.start
+    if symbol.provider is None:
+        decl_start = symbol.decl.selection_range().start
+        if decl_start.line == start.line and decl_start.column == start.column:
+            modifiers.append(lsp.SemanticTokenModifiers.Declaration)
+    elif script_name(symbol.provider.name()) == "nwscript":
+        modifiers.append(lsp.SemanticTokenModifiers.DefaultLibrary)
+
+    return semantic_tokens.SemanticToken(
+        start.line - 1,
+        start.column,
+        token.loc.range.end.column - start.column,
+        semantic_tokens.token_type(token_type),
+        semantic_tokens.token_modifiers(*modifiers),
+    )
+
 
+def _semantic_tokens(script_context: ScriptContext, paths: List[str], nss: rollnw.script.Nss,
+                     source: str, cancel: Optional[CancellationToken] = None) -> List[int]:
+    tokens = []
+
+    def add(token, symbol):
+        result = _semantic_token(token, symbol)
+        if result is not None:
+            tokens.append(result)
+
+    resolve_identifiers(script_context, paths, nss, source, add, cancel)
+    return semantic_tokens.encode(tokens)
+
+
+async def _document_semantic_tokens(ls: NWScriptLanguageServer, uri: str) -> Tuple[int, List[int]]:
+    """Gets the document version and encoded semantic tokens of ``uri``."""
+    text_doc = ls.workspace.get_text_document(uri)
+    version = text_doc.version
+    source = text_doc.source
+    nss, text_doc = await _load_nss(ls, uri)
+    token = CancellationToken()
+    data = await ls.workers.run_once(
+        ("semantic_tokens", ls.session_id, uri, version),
+        _semantic_tokens,
+        ls.script_context,
+        _include_paths(ls, text_doc.path),
+        nss,
+        source,
+        token,
+        token=token,
+    )
+    _check_version(ls, uri, version)
+    return version, data
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL, semantic_tokens.LEGEND)
+async def semantic_tokens_full(ls: NWScriptLanguageServer,
+                               params: lsp.SemanticTokensParams) -> lsp.SemanticTokens:
+    uri = params.text_document.uri
+    latest = ls.semantic_tokens.latest(uri, ls.workspace.get_text_document(uri).version)
+    if latest is not None:
+        result_id, data = latest
+        return lsp.SemanticTokens(data=data, result_id=result_id)
+
+    version, data = await _document_semantic_tokens(ls, uri)
+    return lsp.SemanticTokens(data=data, result_id=ls.semantic_tokens.put(uri, version, data))
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL_DELTA, semantic_tokens.LEGEND)
+async def semantic_tokens_full_delta(
+    ls: NWScriptLanguageServer,
+    params: lsp.SemanticTokensDeltaParams,
+) -> Union[lsp.SemanticTokens, lsp.SemanticTokensDelta]:
+    """Returns only the token runs changed since ``previous_result_id``."""
+    uri = params.text_document.uri
+    previous = ls.semantic_tokens.get(uri, params.previous_result_id)
+
+    latest = ls.semantic_tokens.latest(uri, ls.workspace.get_text_document(uri).version)
+    if latest is not None:
+        result_id, data = latest
+    else:
+        version, data = await _document_semantic_tokens(ls, uri)
+        result_id = ls.semantic_tokens.put(uri, version, data)
+
+    if previous is None:
+        return lsp.SemanticTokens(data=data, result_id=result_id)
+
+    return lsp.SemanticTokensDelta(
+        edits=semantic_tokens.diff(previous, data), result_id=result_id)
+
+
+def _signature_help(nss: rollnw.script.Nss, position: lsp.Position,
+                    markup_kind: lsp.MarkupKind) -> Optional[lsp.SignatureHelp]:
     sig_help = nss.signature_help(
-        params.position.line + 1, params.position.character)
+        position.line + 1, position.character)
 
     if not isinstance(sig_help.expr, rollnw.script.CallExpression):
         return
 
     signatures = []
-    markup_kind = _choose_markup(SERVER)
 
     if isinstance(sig_help.decl, rollnw.script.FunctionDecl):
         sig = lsp.SignatureInformation(sig_help.decl.identifier())
@@ -336,8 +1432,249 @@ def text_document_signature_help(params: lsp.SignatureHelpParams) -> Optional[ls
     return lsp.SignatureHelp(signatures, 0, sig_help.active_param)
 
 
+@SERVER.feature(lsp.TEXT_DOCUMENT_SIGNATURE_HELP,
+                lsp.SignatureHelpOptions(trigger_characters=["(", ","]))
+async def text_document_signature_help(ls: NWScriptLanguageServer,
+                                       params: lsp.SignatureHelpParams) -> Optional[lsp.SignatureHelp]:
+    nss, text_doc = await _load_nss(ls, params.text_document.uri)
+
+    return await _query(ls, _signature_help, nss, params.position, _choose_markup(ls))
+
+
+def _declaration(nss: rollnw.script.Nss, needle: str, position: lsp.Position,
+                 script: str) -> Optional[Tuple[SymbolKey, lsp.Range]]:
+    symbol = nss.locate_symbol(needle, position.line + 1, position.character)
+    key = reference_key(symbol, script)
+    if key is None:
+        return None
+    return key, convert_range(symbol.decl.selection_range())
+
+
+async def _locate_declaration(ls: NWScriptLanguageServer, uri: str, position: lsp.Position
+                              ) -> Tuple[Optional[SymbolKey], Optional[lsp.Location]]:
+    """Finds the declaration of the symbol at ``position``.
+
+    The location is ``None`` if the declaring script is not part of the
+    workspace, e.g. for functions from ``nwscript.nss``.
+    """
+    nss, text_doc = await _load_nss(ls, uri)
+    needle = text_doc.word_at_position(position)
+    name = script_name(text_doc.path)
+    result = await _query(ls, _declaration, nss, needle, position, name)
+    if result is None:
+        return None, None
+
+    key, range = result
+    path = text_doc.path if key.script == name else ls.include_paths.find(key.script)
+    if path is None:
+        return key, None
+    return key, lsp.Location(from_fs_path(path), range)
+
+
+def _reference_locations(ls: NWScriptLanguageServer, key: SymbolKey) -> List[lsp.Location]:
+    return [
+        lsp.Location(from_fs_path(path), lsp.Range(lsp.Position(sl, sc), lsp.Position(el, ec)))
+        for path, (sl, sc, el, ec) in ls.reference_index.references(key)
+    ]
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_DEFINITION)
+async def text_document_definition(ls: NWScriptLanguageServer,
+                                   params: lsp.DefinitionParams) -> Optional[lsp.Location]:
+    key, location = await _locate_declaration(ls, params.text_document.uri, params.position)
+    return location
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_REFERENCES)
+async def text_document_references(ls: NWScriptLanguageServer,
+                                   params: lsp.ReferenceParams) -> Optional[List[lsp.Location]]:
+    uri = params.text_document.uri
+    await _index_references(ls, uri)
+
+    key, declaration = await _locate_declaration(ls, uri, params.position)
+    if key is None:
+        return None
+
+    result = []
+    for location in _reference_locations(ls, key):
+        if location == declaration and not params.context.include_declaration:
+            continue
+        result.append(location)
+
+    if params.context.include_declaration and declaration is not None \
+            and declaration not in result:
+        result.append(declaration)
+
+    return result
+
+
+@SERVER.feature(lsp.TEXT_DOCUMENT_RENAME)
+async def text_document_rename(ls: NWScriptLanguageServer,
+                               params: lsp.RenameParams) -> Optional[lsp.WorkspaceEdit]:
+    if not IDENTIFIER_RE.fullmatch(params.new_name):
+        ls.show_message(f"'{params.new_name}' is not a valid identifier", lsp.MessageType.Error)
+        return None
+
+    uri = params.text_document.uri
+    await _index_references(ls, uri)
+
+    key, declaration = await _locate_declaration(ls, uri, params.position)
+    if declaration is None:
+        if key is not None:
+            ls.show_message(f"'{key.name}' is not declared in the workspace", lsp.MessageType.Error)
+        return None
+
+    # A rename missing the references of any script would break it, so the
+    # scripts the index lacks are indexed first and the rename is refused
+    missing = _unindexed_scripts(ls)
+    if missing:
+        if ls.index_task is None or ls.index_task.done():
+            ls.index_task = ls.loop.create_task(_background(_index_files, ls, missing))
+        ls.show_message(f"Can't rename until every script is indexed, {len(missing)} are "
+                        "being indexed now", lsp.MessageType.Warning)
+        return None
+
+    locations = _reference_locations(ls, key)
+    if declaration not in locations:
+        locations.append(declaration)
+
+    changes = {}
+    for location in locations:
+        changes.setdefault(location.uri, []).append(
+            lsp.TextEdit(location.range, params.new_name))
+
+    return lsp.WorkspaceEdit(changes=changes)
+
+
+@SERVER.command("nwscriptd.stats")
+def stats_command(ls: NWScriptLanguageServer, args):
+    """Returns latency percentiles per LSP method and processing phase.
+
+    The current depth of the worker queues is returned under ``queues``.
+    Passing ``{"reset": true}`` clears the statistics after returning them.
+    """
+    result = ls.stats.snapshot()
+    result["queues"] = ls.workers.queue_depths()
+    if args and isinstance(args[0], dict) and args[0].get("reset"):
+        ls.stats.reset()
+    return result
+
+
+@SERVER.command("nwscriptd.memory")
+def memory_command(ls: NWScriptLanguageServer, args):
+    """Returns the memory used by the process and the server's caches."""
+    return ls.memory()
+
+
+@SERVER.feature(lsp.WORKSPACE_DID_CHANGE_WATCHED_FILES)
+def did_change_watched_files(ls: NWScriptLanguageServer, params: lsp.DidChangeWatchedFilesParams):
+    """Workspace watched files did change notification."""
+    # Every client of a daemon watches the files of its workspace, the
+    # shared state is updated from one of them
+    if ls.daemon is not None and not ls.daemon.handles_watched_files(ls):
+        return
+
+    for change in params.changes:
+        path = to_fs_path(change.uri)
+        if path is None:
+            continue
+
+        uri = from_fs_path(path)
+        if change.type == lsp.FileChangeType.Deleted:
+            ls.reference_debouncer.cancel(uri)
+            ls.include_paths.remove(path)
+            ls.symbol_index.remove(path)
+            ls.reference_index.remove(path)
+            ls.stale_references.discard(path)
+            if ls.symbol_cache is not None:
+                ls.symbol_cache.remove(path)
+        else:
+            # Positions recorded before the change can't be trusted for a
+            # rename until the script is indexed again
+            ls.include_paths.add(path)
+            ls.stale_references.add(path)
+            ls.reference_debouncer.schedule(uri, _background, _index_file, ls, path)
+
+        if change.type != lsp.FileChangeType.Created:
+            _revalidate(ls.invalidate_script(path))
+
+
+@SERVER.feature(lsp.SHUTDOWN)
+def shutdown(ls: NWScriptLanguageServer, params):
+    ls.cancel_prefetch()
+    ls.symbol_cache_debouncer.cancel("save")
+    # Also writes what a debounced save staged but hasn't flushed yet
+    if ls.symbol_cache is not None:
+        ls.symbol_cache.save()
+
+    # A daemon carries on with its other clients and their shared work
+    if ls.daemon is not None:
+        return
+
+    ls.workspace_state.cancel_tasks()
+    ls.workers.shutdown()
+
+
+@SERVER.feature(lsp.INITIALIZED)
+def initialized(ls: NWScriptLanguageServer, params: lsp.InitializedParams):
+    # Progress can only be reported once the client has been initialized
+    if ls.preindex_processes and ls.workspace.root_path:
+        ls.preindex_task = ls.loop.create_task(
+            _preindex_workspace(ls, ls.preindex_processes))
+
+    can_watch = get_capability(
+        ls.client_capabilities,
+        "workspace.did_change_watched_files.dynamic_registration",
+        False,
+    )
+    if not can_watch:
+        return
+
+    if ls.daemon is not None:
+        ls.daemon.watch(ls)
+    ls.register_capability(lsp.RegistrationParams(registrations=[
+        lsp.Registration(
+            id=str(uuid.uuid4()),
+            method=lsp.WORKSPACE_DID_CHANGE_WATCHED_FILES,
+            register_options=lsp.DidChangeWatchedFilesRegistrationOptions(
+                watchers=[lsp.FileSystemWatcher(glob_pattern="**/*.nss")]),
+        )
+    ]))
+
+
 @SERVER.feature(lsp.INITIALIZE)
-def initialize(params: lsp.InitializeParams):
-    rollnw.kernel.start()
+def initialize(ls: NWScriptLanguageServer, params: lsp.InitializeParams):
+    # Features served from the symbol cache and indexes work right away,
+    # anything that resolves scripts waits for the kernel to finish loading.
+    # The kernel is shared by every client of a daemon, the first decides
+    # what it loads
+    if not ls.kernel.started:
+        ls.kernel.include_install = ls.kernel.include_install and _init_option(
+            params, "includeInstall", True)
+        ls.kernel.include_user = ls.kernel.include_user and _init_option(
+            params, "includeUser", True)
+    ls.kernel.start(ls.script_context.lock).add_done_callback(
+        lambda future: ls.show_message_log(
+            "rollnw kernel failed to start" if future.exception() else "rollnw kernel ready"))
+
+    ls.diagnostics_debouncer.delay = _init_option(
+        params, "diagnosticsDelay", 300) / 1000
+    # One thread is kept for interactive work, so there are at least two.
+    # Clients of a daemon share its pool and can't resize it.
+    if ls.daemon is None:
+        ls.workers.max_workers = max(_init_option(params, "workerThreads", 2), 2)
+    ls.completion_limit = _init_option(params, "completionLimit", 200)
+    ls.documents.budget = _init_option(params, "closedDocumentsBudget", 64) * 1024 * 1024
+
+    # A daemon shares the indexes of a workspace, only the first of its
+    # clients to open it builds them
+    root_path = ls.workspace.root_path
+    if root_path and (ls.daemon is None or not ls.daemon.attach(ls, root_path)):
+        ls.include_paths.build(ls.workspace.root_path)
+        if _init_option(params, "symbolCache", True):
+            _load_symbol_cache(ls, ls.workspace.root_path)
+        if _init_option(params, "preindex", False):
+            ls.preindex_processes = _init_option(
+                params, "preindexProcesses", 0) or preindex.default_processes()
 
     # [TODO] All client capabilities:
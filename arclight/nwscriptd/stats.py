@@ -0,0 +1,111 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the histogram buckets in milliseconds, doubling from 0.25ms
+# to about a minute.  The last bucket catches everything slower.
+BUCKETS: List[float] = [0.25 * 2 ** i for i in range(19)]
+
+
+class Histogram:
+    """Latency histogram with exponentially sized buckets.
+
+    Percentiles are estimated as the upper bound of the bucket they fall in,
+    capped to the largest value recorded, so they are accurate to within a
+    factor of two while recording is constant time and memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, ms: float):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.buckets[bisect.bisect_left(BUCKETS, ms)] += 1
+
+    def percentile(self, p: float) -> float:
+        """Estimates the ``p``th percentile, ``p`` being between 0 and 100."""
+        if self.count == 0:
+            return 0.0
+
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": round(self.max, 3),
+        }
+
+
+class Stats:
+    """Latency histograms by category, e.g. LSP method or processing phase.
+
+    Phases are timed on worker threads, so recording is guarded by a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def record(self, category: str, name: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get((category, name))
+            if histogram is None:
+                histogram = self._histograms[(category, name)] = Histogram()
+            histogram.record(seconds * 1000)
+
+    @contextmanager
+    def timer(self, category: str, name: str) -> Iterator[None]:
+        """Records the time spent in the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Gets a summary of every histogram, grouped by category."""
+        result: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        with self._lock:
+            for (category, name), histogram in sorted(self._histograms.items()):
+                result.setdefault(category, {})[name] = histogram.summary()
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+def process_memory() -> Optional[int]:
+    """Gets the resident memory of the process in bytes, if it can be determined."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Peak rather than current usage, in kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
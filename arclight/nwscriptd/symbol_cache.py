@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT = 2
+# Outdated lines tolerated in the log before it is rewritten
+COMPACT_SLACK = 64
+
+
+def content_hash(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def file_hash(path: str) -> Optional[str]:
+    """Gets the content hash of the script at ``path``, ``None`` if it can't be read."""
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return content_hash(f.read())
+    except OSError:
+        return None
+
+
+class SymbolCache:
+    """On-disk cache of the exports and includes of each script.
+
+    Entries are keyed by script path, relative to the cache's workspace root,
+    and are only returned if the hash of the script's content still matches.
+    The whole cache is discarded if it was written by a different cache
+    format or rollnw version.
+
+    The file is a log of JSON lines, a header followed by one line per entry
+    written or removed, the last line for a script wins.  Saving only appends
+    the entries changed since the last save, so an edit doesn't rewrite the
+    whole cache.  The log is rewritten from scratch once it holds mostly
+    outdated lines.  Saving is split in two: :meth:`stage` takes the changes
+    on the thread that owns the cache, :meth:`flush` serializes and writes
+    them and can run on any thread.
+    """
+
+    def __init__(self, root: str, path: str, version: str):
+        self.root = root
+        self.path = path
+        self.version = version
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._changed: Set[str] = set()
+        # Number of entry lines in the log on disk once staged writes are
+        # done, ``None`` until a usable log has been loaded or written
+        self._records: Optional[int] = None
+        self._staged: Deque[Tuple[bool, List[Tuple[str, Optional[Dict[str, Any]]]]]] = deque()
+        self._flush_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def dirty(self) -> bool:
+        """Whether entries changed since the last :meth:`stage`."""
+        return bool(self._changed)
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _header(self) -> Dict[str, Any]:
+        return {"format": CACHE_FORMAT, "rollnw": self.version}
+
+    def load(self) -> bool:
+        """Loads the cache from disk, returns ``False`` if there was nothing usable."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            header = json.loads(lines[0]) if lines else None
+        except (OSError, ValueError):
+            return False
+
+        if header != self._header():
+            logger.info("Ignoring stale symbol cache %s", self.path)
+            return False
+
+        entries: Dict[str, Dict[str, Any]] = {}
+        records: Optional[int] = len(lines) - 1
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A save interrupted halfway leaves a partial last line, the
+                # log is rewritten rather than appended to
+                records = None
+                break
+            if record["entry"] is None:
+                entries.pop(record["path"], None)
+            else:
+                entries[record["path"]] = record["entry"]
+
+        self._entries = entries
+        self._changed.clear()
+        self._records = records
+        return True
+
+    def stage(self):
+        """Takes the changes to write and marks the cache clean.
+
+        Only entry references are copied, nothing is serialized, so this is
+        cheap enough for the event loop.
+        """
+        if not self._changed:
+            return
+
+        rewrite = self._records is None or \
+            self._records + len(self._changed) > 2 * len(self._entries) + COMPACT_SLACK
+        keys = list(self._entries) if rewrite else sorted(self._changed)
+        # Entries are copied since references are added to them in place
+        records = [(key, dict(self._entries[key]) if key in self._entries else None)
+                   for key in keys]
+        self._records = len(records) if rewrite else self._records + len(records)
+        self._changed.clear()
+        self._staged.append((rewrite, records))
+
+    def flush(self):
+        """Writes staged changes to disk, in the order they were staged."""
+        with self._flush_lock:
+            while self._staged:
+                rewrite, records = self._staged.popleft()
+                lines = [json.dumps({"path": key, "entry": entry}) + "\n" for key, entry in records]
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if rewrite:
+                    tmp = f"{self.path}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(json.dumps(self._header()) + "\n")
+                        f.writelines(lines)
+                    os.replace(tmp, self.path)
+                else:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.writelines(lines)
+
+    def save(self):
+        """Stages and writes changes at once, for callers that may block."""
+        self.stage()
+        self.flush()
+
+    def get(self, path: str, digest: str) -> Optional[Dict[str, Any]]:
+        """Gets the entry for ``path`` if its content hash is ``digest``."""
+        entry = self._entries.get(self._key(path))
+        if entry is None or entry["hash"] != digest:
+            return None
+        return entry
+
+    def put(self, path: str, digest: str, exports: List[Dict[str, Any]], includes: List[str]):
+        key = self._key(path)
+        entry = {
+            "hash": digest,
+            "exports": exports,
+            "includes": includes,
+        }
+        old = self._entries.get(key)
+        if old is not None and old["hash"] == digest and "references" in old:
+            entry["references"] = old["references"]
+        self._entries[key] = entry
+        self._changed.add(key)
+
+    def set_references(self, path: str, digest: str, references: List[List[Any]]):
+        """Stores the references of ``path``, if its entry matches ``digest``."""
+        key = self._key(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry["hash"] == digest:
+            entry["references"] = references
+            self._changed.add(key)
+
+    def remove(self, path: str):
+        key = self._key(path)
+        if self._entries.pop(key, None) is not None:
+            self._changed.add(key)
+
+    def hashes(self) -> Dict[str, str]:
+        """Gets the content hash of every entry by absolute script path.
+
+        The result is a copy, :func:`changed_scripts` can check it on a
+        worker thread while the cache keeps changing.
+        """
+        return {os.path.join(self.root, key): entry["hash"] for key, entry in self._entries.items()}
+
+    def drop(self, hashes: Dict[str, str]) -> List[str]:
+        """Drops the entries of the scripts in ``hashes`` that still have that hash.
+
+        Returns the paths dropped, entries written again since are kept.
+        """
+        dropped = []
+        for path, digest in hashes.items():
+            key = self._key(path)
+            entry = self._entries.get(key)
+            if entry is not None and entry["hash"] == digest:
+                del self._entries[key]
+                self._changed.add(key)
+                dropped.append(path)
+        return dropped
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Iterates over absolute script paths and their entries."""
+        for key, entry in self._entries.items():
+            yield os.path.join(self.root, key), entry
+
+
+def changed_scripts(hashes: Dict[str, str]) -> Dict[str, str]:
+    """Gets the scripts whose content on disk no longer has the given hash.
+
+    Scripts can change while the server isn't running, e.g. by a checkout.
+    Reads every script, so this runs on a worker thread.
+    """
+    return {path: digest for path, digest in hashes.items() if file_hash(path) != digest}
@@ -0,0 +1,98 @@
+from typing import Any, Dict, Iterable, List, NamedTuple, Set
+
+from .fuzzy import fuzzy_rank
+
+
+class IndexedSymbol(NamedTuple):
+    name: str
+    kind: int
+    path: str
+    range: Dict[str, Any]
+
+
+def _trigrams(name: str) -> Set[str]:
+    name = name.lower()
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class SymbolIndex:
+    """In-memory index of the symbols exported by every known script.
+
+    Symbols are indexed by the trigrams of their lower case names, which
+    finds substring matches, and by their first letter, which covers short
+    queries and abbreviations like ``GLI``.  Candidates are then ranked with
+    :func:`fuzzy_rank`.  Scripts are replaced as a unit, so the index can be
+    kept current one file at a time.
+    """
+
+    def __init__(self):
+        self._next_id = 0
+        self._symbols: Dict[int, IndexedSymbol] = {}
+        self._by_path: Dict[str, List[int]] = {}
+        self._by_trigram: Dict[str, Set[int]] = {}
+        self._by_initial: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._symbols)
+
+    def update(self, path: str, symbols: Iterable[Dict[str, Any]]):
+        """Replaces the symbols of the script at ``path``.
+
+        ``symbols`` are unstructured ``DocumentSymbol`` objects.
+        """
+        self.remove(path)
+
+        ids = []
+        for symbol in symbols:
+            name = symbol["name"]
+            if not name:
+                continue
+
+            id = self._next_id
+            self._next_id += 1
+            self._symbols[id] = IndexedSymbol(
+                name, symbol["kind"], path, symbol["selectionRange"])
+            self._by_initial.setdefault(name[0].lower(), set()).add(id)
+            for trigram in _trigrams(name):
+                self._by_trigram.setdefault(trigram, set()).add(id)
+            ids.append(id)
+
+        self._by_path[path] = ids
+
+    def remove(self, path: str):
+        for id in self._by_path.pop(path, ()):
+            symbol = self._symbols.pop(id)
+            self._discard(self._by_initial, symbol.name[0].lower(), id)
+            for trigram in _trigrams(symbol.name):
+                self._discard(self._by_trigram, trigram, id)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[int]], key: str, id: int):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del index[key]
+
+    def search(self, query: str, limit: int = 100) -> List[IndexedSymbol]:
+        """Finds symbols fuzzily matching ``query``, best matches first."""
+        if not query:
+            return [self._symbols[id] for id in sorted(self._symbols)[:limit]]
+
+        candidates = set(self._by_initial.get(query[0].lower(), ()))
+        trigrams = _trigrams(query)
+        if trigrams:
+            substring = None
+            for trigram in trigrams:
+                ids = self._by_trigram.get(trigram, set())
+                substring = ids if substring is None else substring & ids
+                if not substring:
+                    break
+            candidates |= substring
+
+        return fuzzy_rank(
+            query,
+            (self._symbols[id] for id in sorted(candidates)),
+            key=lambda s: s.name,
+            limit=limit,
+        )
@@ -0,0 +1,101 @@
+from typing import List, Optional
+
+from lsprotocol import types as lsp
+from pygls.workspace import TextDocument, Workspace
+
+
+class LineIndexedDocument(TextDocument):
+    """Text document stored as a list of lines.
+
+    pygls keeps a document as a single string and rebuilds it, and every
+    ``lines`` list derived from it, on each incremental change.  Here the
+    lines are the primary representation: an edit only splices the lines it
+    touches, the full source is joined lazily when something asks for it,
+    and line start offsets are cached and only recomputed past the first
+    edited line.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lines: Optional[List[str]] = None
+        self._offsets: List[int] = [0]
+
+    def _invalidate(self, line: int):
+        del self._offsets[line + 1:]
+
+    def _apply_incremental_change(
+        self, change: lsp.TextDocumentContentChangeEvent_Type1
+    ) -> None:
+        lines = self.lines
+        range = self._position_codec.range_from_client_units(lines, change.range)
+        start_line = range.start.line
+        end_line = range.end.line
+
+        prefix = lines[start_line][:range.start.character] if start_line < len(lines) else ""
+        suffix = lines[end_line][range.end.character:] if end_line < len(lines) else ""
+
+        text = prefix + change.text + suffix
+        end = end_line + 1
+
+        # An edit that leaves the last spliced line without a line break
+        # joins it with the next line.
+        if end < len(lines) and text[-1:].splitlines() == [text[-1:]]:
+            text += lines[end]
+            end += 1
+
+        lines[start_line:end] = text.splitlines(True)
+        self._source = None
+        self._invalidate(start_line)
+
+    def _apply_full_change(self, change: lsp.TextDocumentContentChangeEvent) -> None:
+        super()._apply_full_change(change)
+        self._lines = None
+        self._invalidate(0)
+
+    @property
+    def lines(self) -> List[str]:
+        """Lines of the document, the returned list must not be modified."""
+        if self._lines is None:
+            self._lines = super().source.splitlines(True)
+        return self._lines
+
+    @property
+    def source(self) -> str:
+        if self._source is None and self._lines is not None:
+            self._source = "".join(self._lines)
+        return super().source
+
+    def line_offset(self, line: int) -> int:
+        """Gets the offset, in client units, of the start of ``line``."""
+        lines = self.lines
+        line = min(line, len(lines))
+        offsets = self._offsets
+        while len(offsets) <= line:
+            i = len(offsets) - 1
+            offsets.append(offsets[i] + self._position_codec.client_num_units(lines[i]))
+        return offsets[line]
+
+    def offset_at_position(self, client_position: lsp.Position) -> int:
+        server_position = self._position_codec.position_from_client_units(
+            self.lines, client_position)
+        return server_position.character + self.line_offset(server_position.line)
+
+
+class LineIndexedWorkspace(Workspace):
+    """Workspace that manages text documents as ``LineIndexedDocument``."""
+
+    def _create_text_document(
+        self,
+        doc_uri: str,
+        source: Optional[str] = None,
+        version: Optional[int] = None,
+        language_id: Optional[str] = None,
+    ) -> TextDocument:
+        return LineIndexedDocument(
+            doc_uri,
+            source=source,
+            version=version,
+            language_id=language_id,
+            sync_kind=self._sync_kind,
+            position_codec=self._position_codec,
+        )
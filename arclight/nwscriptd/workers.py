@@ -0,0 +1,244 @@
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .scheduler import INTERACTIVE, PRIORITY_NAMES, current_priority, set_priority
+from .stats import Stats
+
+
+class Cancelled(Exception):
+    """Raised when work is abandoned because its result is no longer wanted."""
+
+
+class CancellationToken:
+    """Flag checked by work running on a worker thread to stop early.
+
+    Threads can't be interrupted, so long running work calls :meth:`check`
+    at points where it is safe to stop, e.g. between parsing phases.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def check(self):
+        """Raises :class:`Cancelled` if the token has been cancelled."""
+        if self._event.is_set():
+            raise Cancelled()
+
+
+class _Job:
+    def __init__(self, priority: int, fn: Callable[..., Any], args):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.queued = time.perf_counter()
+        self.taken = False
+
+
+class _Pending:
+    def __init__(self, future: asyncio.Future, token: Optional[CancellationToken],
+                 job: Optional[_Job]):
+        self.future = future
+        self.token = token
+        self.job = job
+        self.waiters = 0
+
+
+class WorkerPool:
+    """Bounded pool of threads that runs parsing and semantic analysis.
+
+    Handlers await work submitted here instead of running it on the event
+    loop, so the server keeps reading and answering messages while a large
+    script is being resolved.
+
+    Work is run in order of :mod:`.scheduler` priority, taken from the
+    submitting task, then in order of submission.  One thread is kept free
+    of anything but interactive work, so completion and hover never wait
+    for a thread behind diagnostics or indexing.  How long work waited to
+    start is recorded in ``stats`` under the ``queue`` category.
+    """
+
+    def __init__(self, max_workers: int = 2, stats: Optional[Stats] = None):
+        self.max_workers = max_workers
+        self.stats = stats
+        self._pending: Dict[Hashable, _Pending] = {}
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[int, int, _Job]] = []
+        self._seq = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self._running: Dict[int, int] = {p: 0 for p in PRIORITY_NAMES}
+        self._shutdown = False
+
+    def _start_threads(self):
+        while len(self._threads) < self.max_workers:
+            thread = threading.Thread(
+                target=self._work,
+                name=f"nwscriptd-worker_{len(self._threads)}",
+                daemon=True,
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def _submit(self, priority: int, fn: Callable[..., Any], args) -> _Job:
+        job = _Job(priority, fn, args)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule work after shutdown")
+            self._start_threads()
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def _promote(self, job: _Job, priority: int):
+        # The stale heap entry is skipped once the job has been taken
+        with self._cond:
+            if job.taken or priority >= job.priority:
+                return
+            job.priority = priority
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+
+    def _take(self) -> Optional[_Job]:
+        background_slots = max(self.max_workers - 1, 1)
+        while self._queue:
+            priority, _, job = self._queue[0]
+            if job.taken or priority != job.priority:
+                heapq.heappop(self._queue)
+                continue
+            if priority != INTERACTIVE and \
+                    self._background_running() >= background_slots:
+                return None
+
+            heapq.heappop(self._queue)
+            job.taken = True
+            return job
+        return None
+
+    def _background_running(self) -> int:
+        return sum(count for p, count in self._running.items() if p != INTERACTIVE)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    job = self._take()
+                self._running[job.priority] += 1
+
+            running = job.future.set_running_or_notify_cancel()
+            if running:
+                if self.stats is not None:
+                    self.stats.record("queue", PRIORITY_NAMES[job.priority],
+                                      time.perf_counter() - job.queued)
+                set_priority(job.priority)
+                try:
+                    result, error = job.fn(*job.args), None
+                except BaseException as e:
+                    result, error = None, e
+
+            # Done before the result is set, so that the job no longer
+            # counts as running once its caller sees the result
+            with self._cond:
+                self._running[job.priority] -= 1
+                self._cond.notify_all()
+
+            if running:
+                if error is None:
+                    job.future.set_result(result)
+                else:
+                    job.future.set_exception(error)
+
+    async def _run(self, job: _Job) -> Any:
+        return await asyncio.wrap_future(job.future)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Runs ``fn(*args)`` on a worker thread and awaits the result."""
+        return await self._run(self._submit(current_priority(), fn, args))
+
+    async def run_once(self, key: Hashable, fn: Callable[..., Any], *args,
+                       token: Optional[CancellationToken] = None) -> Any:
+        """Runs ``fn(*args)``, sharing one result between concurrent calls for ``key``.
+
+        Cancelling one caller does not cancel the work other callers are
+        waiting on.  Once every caller has been cancelled the work is
+        dropped if it hasn't started, otherwise ``token``, which ``fn``
+        should have been given, is cancelled.  Work still queued runs at the
+        highest priority of the callers waiting on it.
+        """
+        priority = current_priority()
+        pending = self._pending.get(key)
+        if pending is None:
+            job = self._submit(priority, fn, args)
+            future = asyncio.ensure_future(self._run(job))
+            pending = self._pending[key] = _Pending(future, token, job)
+            future.add_done_callback(functools.partial(self._forget, key))
+        elif pending.job is not None:
+            self._promote(pending.job, priority)
+
+        pending.waiters += 1
+        try:
+            return await asyncio.shield(pending.future)
+        finally:
+            pending.waiters -= 1
+            if pending.waiters == 0 and not pending.future.done():
+                self._abandon(key, pending)
+                pending.future.cancel()
+
+    def cancel(self, match: Callable[[Hashable], bool]):
+        """Cancels the tokens of pending work whose key satisfies ``match``.
+
+        Callers waiting on the work get :class:`Cancelled` once it reaches
+        its next check.
+        """
+        for key, pending in list(self._pending.items()):
+            if match(key):
+                self._abandon(key, pending)
+
+    def _abandon(self, key: Hashable, pending: _Pending):
+        # Later calls for the key start afresh rather than joining work
+        # that is about to stop
+        if pending.token is not None:
+            pending.token.cancel()
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        pending = self._pending.get(key)
+        if pending is not None and pending.future is future:
+            del self._pending[key]
+
+    def queue_depths(self) -> Dict[str, Dict[str, int]]:
+        """Gets the number of queued and running jobs per priority class."""
+        with self._cond:
+            queued = {p: 0 for p in PRIORITY_NAMES}
+            for priority, _, job in self._queue:
+                if not job.taken and priority == job.priority:
+                    queued[priority] += 1
+            return {
+                name: {"queued": queued[p], "running": self._running[p]}
+                for p, name in PRIORITY_NAMES.items()
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            for _, _, job in self._queue:
+                job.future.cancel()
+            self._queue.clear()
+            self._cond.notify_all()
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Optional, Set
+
+from .completion_cache import CompletionItemCache
+from .debounce import Debouncer
+from .dependencies import DependencyGraph
+from .include_paths import IncludePathIndex
+from .markup import MarkupCache
+from .reference_index import ReferenceIndex
+from .scheduler import PriorityLock
+from .script_context import ScriptContext
+from .symbol_cache import SymbolCache
+from .symbol_index import SymbolIndex
+
+
+class WorkspaceState:
+    """Caches and indexes of one workspace.
+
+    Every server has one of its own, and clients of a daemon that open the
+    same workspace root share one.  Nothing in it refers back to a client,
+    so a daemon keeps a workspace's state without keeping the documents and
+    caches of the client that built it.  Background work on the whole
+    workspace is tracked here as well, it carries on for the other clients
+    when the one that started it leaves.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, lock: Optional[PriorityLock] = None):
+        self.include_paths = IncludePathIndex(".nss")
+        self.script_context = ScriptContext(lock)
+        self.dependencies = DependencyGraph()
+        self.symbol_cache: Optional[SymbolCache] = None
+        self.symbol_cache_debouncer = Debouncer(loop, delay=5.0)
+        self.symbol_index = SymbolIndex()
+        self.reference_index = ReferenceIndex()
+        # Scripts changed on disk whose indexed references await re-indexing
+        self.stale_references: Set[str] = set()
+        self.completion_items = CompletionItemCache()
+        self.markup_cache = MarkupCache()
+        self.cache_task: Optional[asyncio.Task] = None
+        self.index_task: Optional[asyncio.Task] = None
+        self.preindex_task: Optional[asyncio.Task] = None
+
+    def cancel_tasks(self):
+        """Cancels background work on the workspace."""
+        self.symbol_cache_debouncer.cancel_all()
+        for task in (self.cache_task, self.index_task, self.preindex_task):
+            if task is not None:
+                task.cancel()
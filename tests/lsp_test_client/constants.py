@@ -6,5 +6,5 @@ Constants for use with tests.
 import pathlib
 
 TEST_ROOT = pathlib.Path(__file__).parent.parent
-PROJECT_ROOT = TEST_ROOT.parent.parent.parent
+PROJECT_ROOT = TEST_ROOT.parent
 TEST_DATA = TEST_ROOT / "test_data"
@@ -7,7 +7,7 @@ Default initialize request params.
 import os
 
 from .constants import PROJECT_ROOT
-from .utils import as_uri, get_initialization_options
+from .utils import as_uri
 
 VSCODE_DEFAULT_INITIALIZE = {
     "processId": os.getpid(),
@@ -215,5 +215,5 @@ VSCODE_DEFAULT_INITIALIZE = {
     },
     "trace": "verbose",
     "workspaceFolders": [{"uri": as_uri(str(PROJECT_ROOT)), "name": "my_project"}],
-    "initializationOptions": get_initialization_options(),
+    "initializationOptions": {},
 }
@@ -0,0 +1,281 @@
+"""
+Benchmark harness replaying recorded or synthetic sessions against nwscriptd.
+
+Sessions are recorded by starting the server with ``--record FILE``.  Both
+modes report latency percentiles per LSP method as seen by the client.
+
+Examples:
+
+    python -m tests.lsp_test_client.replay session.jsonl --speed 10
+    python -m tests.lsp_test_client.replay --synthetic path/to/scripts --documents 20
+"""
+
+import argparse
+import copy
+import json
+import pathlib
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import wait
+
+from arclight.nwscriptd.recorder import read_session
+
+from .defaults import VSCODE_DEFAULT_INITIALIZE
+from .session import LspSession
+from .utils import as_uri
+
+# Handled by LspSession itself
+SKIPPED_METHODS = {"initialize", "initialized", "shutdown", "exit"}
+CANCEL_REQUEST = "$/cancelRequest"
+
+TYPED_LINE = '    int nValue = GetLocalInt(OBJECT_SELF, "nwscriptd");'
+
+
+def percentile(values, p):
+    """Gets the ``p``th percentile of ``values`` by nearest rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(p / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies):
+    """Summarizes latencies in milliseconds by method."""
+    return {
+        method: {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values),
+        }
+        for method, values in sorted(latencies.items())
+        if values
+    }
+
+
+def print_report(summary):
+    print(f"{'method':<40} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for method, row in summary.items():
+        print(
+            f"{method:<40} {row['count']:>7} {row['p50']:>9.2f} {row['p95']:>9.2f} "
+            f"{row['p99']:>9.2f} {row['max']:>9.2f}"
+        )
+
+
+class LatencyRecorder:
+    """Sends requests and records the time until their response arrives."""
+
+    def __init__(self, session):
+        self.session = session
+        self.latencies = defaultdict(list)
+        self._pending = []
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    def request(self, method, params=None):
+        start = time.perf_counter()
+        future = self.session.request(method, params)
+
+        def _done(_):
+            # Requests answered after being cancelled measure how quickly
+            # the server gives up, not how quickly it answers
+            with self._lock:
+                name = f"{method} (cancelled)" if future in self._cancelled else method
+                self.latencies[name].append((time.perf_counter() - start) * 1000)
+
+        future.add_done_callback(_done)
+        self._pending.append(future)
+        return future
+
+    def cancel(self, future):
+        with self._lock:
+            if future.done():
+                return
+            self._cancelled.add(future)
+        self.session.cancel_request(future)
+
+    def wait(self, timeout=60):
+        wait(self._pending, timeout=timeout)
+        self._pending = []
+
+
+def _remap(params, uri_map):
+    if not uri_map or params is None:
+        return params
+
+    text = json.dumps(params)
+    for old, new in uri_map.items():
+        text = text.replace(old, new)
+    return json.loads(text)
+
+
+def replay(session, entries, speed=1.0, uri_map=None):
+    """Replays the client messages of a recorded session.
+
+    Messages are sent at their recorded times divided by ``speed``.  The
+    recorded ``initialize`` parameters are used so the server sees the same
+    client capabilities.  Cancellations are sent for the replayed request
+    that the recorded one maps to, if it hasn't been answered yet.  Returns
+    latencies in milliseconds by method, cancelled requests under
+    ``"<method> (cancelled)"``.
+    """
+    entries = [e for e in entries if e["direction"] == "in" and "method" in e["message"]]
+
+    origin = 0.0
+    for entry in entries:
+        if entry["message"]["method"] == "initialize":
+            origin = entry["time"]
+            session.initialize(_remap(entry["message"]["params"], uri_map))
+            break
+    else:
+        session.initialize()
+
+    recorder = LatencyRecorder(session)
+    # Recorded request ids to the futures of their replayed requests
+    sent = {}
+    start = time.perf_counter()
+    for entry in entries:
+        message = entry["message"]
+        if message["method"] in SKIPPED_METHODS:
+            continue
+
+        delay = (entry["time"] - origin) / speed - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+        params = _remap(message.get("params"), uri_map)
+        if message["method"] == CANCEL_REQUEST:
+            future = sent.get(message["params"]["id"])
+            if future is not None:
+                recorder.cancel(future)
+        elif "id" in message:
+            sent[message["id"]] = recorder.request(message["method"], params)
+        else:
+            session.notify(message["method"], params)
+
+    recorder.wait()
+    return recorder.latencies
+
+
+def _position_params(uri, line, character):
+    return {"textDocument": {"uri": uri}, "position": {"line": line, "character": character}}
+
+
+def synthetic_workload(session, root, paths, lines=5, interval=0.02, seed=0):
+    """Simulates typing ``lines`` new lines at the end of each script.
+
+    Documents are edited round robin one character at a time.  Each keystroke
+    sends an incremental change followed by the requests an editor would
+    make: completion on identifiers, signature help on ``(`` and ``,`` and a
+    hover now and then.  Finishing a line requests document symbols, inlay
+    hints and semantic tokens.  Returns latencies in milliseconds by method.
+    """
+    rng = random.Random(seed)
+
+    params = copy.deepcopy(VSCODE_DEFAULT_INITIALIZE)
+    params["rootPath"] = str(root)
+    params["rootUri"] = as_uri(str(root))
+    params["workspaceFolders"] = [{"uri": as_uri(str(root)), "name": root.name}]
+    session.initialize(params)
+
+    documents = []
+    for path in paths:
+        text = path.read_text(encoding="utf-8", errors="replace")
+        uri = as_uri(str(path))
+        session.notify_did_open({
+            "textDocument": {"uri": uri, "languageId": "nwscript", "version": 1, "text": text}
+        })
+        text_lines = text.split("\n")
+        documents.append({
+            "uri": uri, "version": 1, "last_line": len(text_lines) - 1, "last_len": len(text_lines[-1])
+        })
+
+    def _insert(doc, line, character, text):
+        doc["version"] += 1
+        position = {"line": line, "character": character}
+        session.notify_did_change({
+            "textDocument": {"uri": doc["uri"], "version": doc["version"]},
+            "contentChanges": [{"range": {"start": position, "end": position}, "text": text}],
+        })
+
+    recorder = LatencyRecorder(session)
+    for _ in range(lines):
+        for doc in documents:
+            uri = doc["uri"]
+            _insert(doc, doc["last_line"], doc["last_len"], "\n")
+            line = doc["last_line"] + 1
+
+            for character, ch in enumerate(TYPED_LINE):
+                _insert(doc, line, character, ch)
+                cursor = character + 1
+                if ch.isalnum() or ch == "_":
+                    recorder.request("textDocument/completion",
+                                     _position_params(uri, line, cursor))
+                elif ch in "(,":
+                    recorder.request("textDocument/signatureHelp",
+                                     _position_params(uri, line, cursor))
+                if rng.random() < 0.1:
+                    recorder.request("textDocument/hover",
+                                     _position_params(uri, line, rng.randrange(cursor)))
+                time.sleep(interval)
+
+            doc["last_line"] = line
+            doc["last_len"] = len(TYPED_LINE)
+            recorder.request("textDocument/documentSymbol", {"textDocument": {"uri": uri}})
+            recorder.request("textDocument/inlayHint", {
+                "textDocument": {"uri": uri},
+                "range": {"start": {"line": max(line - 50, 0), "character": 0},
+                          "end": {"line": line + 1, "character": 0}},
+            })
+            recorder.request("textDocument/semanticTokens/full", {"textDocument": {"uri": uri}})
+
+    recorder.wait()
+    return recorder.latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay nwscriptd sessions and report latency percentiles.")
+    parser.add_argument("session", nargs="?", help="session recorded with --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed up factor (default 1, original timing)")
+    parser.add_argument("--map-uri", nargs=2, action="append", default=[],
+                        metavar=("OLD", "NEW"), help="replace a URI prefix when replaying")
+    parser.add_argument("--synthetic", type=pathlib.Path,
+                        help="generate a typing workload for the scripts in this directory")
+    parser.add_argument("--documents", type=int, default=10,
+                        help="number of scripts to edit in a synthetic workload")
+    parser.add_argument("--lines", type=int, default=5,
+                        help="lines to type into each script in a synthetic workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra argument for the server, may be repeated")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    if (args.session is None) == (args.synthetic is None):
+        parser.error("specify either a recorded session or --synthetic")
+
+    with LspSession(args=args.server_arg) as session:
+        if args.synthetic is not None:
+            paths = sorted(args.synthetic.rglob("*.nss"))
+            paths = random.Random(args.seed).sample(paths, min(args.documents, len(paths)))
+            latencies = synthetic_workload(
+                session, args.synthetic.resolve(), paths, lines=args.lines, seed=args.seed)
+        else:
+            latencies = replay(session, read_session(args.session), speed=args.speed,
+                               uri_map=dict(args.map_uri))
+
+    summary = summarize(latencies)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ LSP session client for testing.
 import os
 import subprocess
 import sys
+import uuid
 from concurrent.futures import Future, ThreadPoolExecutor
 from threading import Event
 
@@ -14,7 +15,6 @@ from pyls_jsonrpc.dispatchers import MethodDispatcher
 from pyls_jsonrpc.endpoint import Endpoint
 from pyls_jsonrpc.streams import JsonRpcStreamReader, JsonRpcStreamWriter
 
-from .constants import PROJECT_ROOT
 from .defaults import VSCODE_DEFAULT_INITIALIZE
 
 LSP_EXIT_TIMEOUT = 5000
@@ -29,7 +29,7 @@ WINDOW_SHOW_MESSAGE = "window/showMessage"
 class LspSession(MethodDispatcher):
     """Send and Receive messages over LSP as a test LS Client."""
 
-    def __init__(self, cwd=None, script=None):
+    def __init__(self, cwd=None, script=None, args=None):
         self.cwd = cwd if cwd else os.getcwd()
         # pylint: disable=consider-using-with
         self._thread_pool = ThreadPoolExecutor()
@@ -38,18 +38,24 @@ class LspSession(MethodDispatcher):
         self._reader = None
         self._endpoint = None
         self._notification_callbacks = {}
-        self.script = (
-            script if script else (PROJECT_ROOT / "bundled" / "tool" / "lsp_server.py")
-        )
+        self._last_request_id = None
+        self._request_ids = {}
+        self.script = script
+        self.args = list(args) if args else []
 
     def __enter__(self):
         """Context manager entrypoint.
 
         shell=True needed for pytest-cov to work in subprocess.
         """
+        if self.script:
+            command = [sys.executable, str(self.script)]
+        else:
+            command = [sys.executable, "-m", "arclight.nwscriptd"]
+
         # pylint: disable=consider-using-with
         self._sub = subprocess.Popen(
-            [sys.executable, str(self.script)],
+            command + self.args,
             stdout=subprocess.PIPE,
             stdin=subprocess.PIPE,
             bufsize=0,
@@ -66,7 +72,7 @@ class LspSession(MethodDispatcher):
             WINDOW_SHOW_MESSAGE: self._window_show_message,
             WINDOW_LOG_MESSAGE: self._window_log_message,
         }
-        self._endpoint = Endpoint(dispatcher, self._writer.write)
+        self._endpoint = Endpoint(dispatcher, self._writer.write, id_generator=self._next_id)
         self._thread_pool.submit(self._reader.listen, self._endpoint.consume)
         return self
 
@@ -158,6 +164,27 @@ class LspSession(MethodDispatcher):
         )
         return fut.result()
 
+    def request(self, method, params=None):
+        """Sends a {method} request to the LSP server and returns its future."""
+        fut = self._send_request(method, params=params)
+        self._request_ids[fut] = self._last_request_id
+        fut.add_done_callback(lambda f: self._request_ids.pop(f, None))
+        return fut
+
+    def cancel_request(self, fut):
+        """Asks the LSP server to cancel the request sent by `request`.
+
+        The future still completes with the server's response, the request
+        is not forgotten on this side.
+        """
+        msg_id = self._request_ids.get(fut)
+        if msg_id is not None:
+            self._send_notification("$/cancelRequest", params={"id": msg_id})
+
+    def notify(self, method, params=None):
+        """Sends a {method} notification to the LSP server."""
+        self._send_notification(method, params=params)
+
     def set_notification_callback(self, notification_name, callback):
         """Set custom LS notification handler."""
         self._notification_callbacks[notification_name] = callback
@@ -202,6 +229,10 @@ class LspSession(MethodDispatcher):
         self._thread_pool.submit(_handler)
         return fut
 
+    def _next_id(self):
+        self._last_request_id = str(uuid.uuid4())
+        return self._last_request_id
+
     def _send_request(self, name, params=None, handle_response=lambda f: f.done()):
         """Sends {name} request to the LSP server."""
         fut = self._endpoint.request(name, params)
@@ -1,6 +1,45 @@
 """Test the CLI."""
 
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+from lsprotocol import types as lsp
+from pygls.workspace import TextDocument
+
+from arclight.nwscriptd import analysis, kernel, preindex
+from arclight.nwscriptd import server as server_module
 from arclight.nwscriptd.cli import cli, get_version
+from arclight.nwscriptd.completion_cache import CompletionItemCache
+from arclight.nwscriptd.daemon import Daemon
+from arclight.nwscriptd.debounce import Debouncer
+from arclight.nwscriptd.dependencies import DependencyGraph
+from arclight.nwscriptd.diagnostics import make_result_id
+from arclight.nwscriptd.documents import SIZE_PER_CHAR, DocumentCache
+from arclight.nwscriptd.fuzzy import fuzzy_rank, fuzzy_score
+from arclight.nwscriptd.include_paths import IncludePathIndex
+from arclight.nwscriptd.inlay_hints import InlayHintCache
+from arclight.nwscriptd.kernel import KernelLoader
+from arclight.nwscriptd.markup import MarkupCache
+from arclight.nwscriptd.recorder import SessionRecorder, read_session
+from arclight.nwscriptd.reference_index import ReferenceIndex, SymbolKey
+from arclight.nwscriptd.scheduler import (BACKGROUND, DIAGNOSTICS, INTERACTIVE, PriorityLock,
+                                          priority, set_priority)
+from arclight.nwscriptd.script_context import ScriptContext
+from arclight.nwscriptd.semantic_tokens import SemanticToken, diff, encode
+from arclight.nwscriptd.server import (SERVER, _add_preindexed, _cancel_outdated, _index_file,
+                                       _rank_completions, _revalidate, did_change_watched_files,
+                                       did_close, text_document_rename, workspace_diagnostic,
+                                       workspace_symbol)
+from arclight.nwscriptd.stats import Stats
+from arclight.nwscriptd.symbol_cache import SymbolCache, changed_scripts, content_hash
+from arclight.nwscriptd.symbol_index import SymbolIndex
+from arclight.nwscriptd.text_document import LineIndexedDocument
+from arclight.nwscriptd.workers import CancellationToken, Cancelled, WorkerPool
 
 
 def test_get_version() -> None:
@@ -11,3 +50,960 @@ def test_get_version() -> None:
 def test_cli() -> None:
     """Test the basic cli behavior."""
     assert cli
+
+
+def test_include_path_index(tmp_path) -> None:
+    """Test that the include path index tracks directories with scripts."""
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "inc_a.nss").write_text("")
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "readme.txt").write_text("")
+
+    index = IncludePathIndex(".nss")
+    index.build(str(tmp_path))
+    assert index.paths() == [str(tmp_path / "a")]
+
+    assert index.add(str(tmp_path / "b" / "inc_b.nss"))
+    assert not index.add(str(tmp_path / "b" / "inc_c.nss"))
+    assert not index.add(str(tmp_path / "b" / "notes.txt"))
+    assert str(tmp_path / "b") in index
+    assert index.find("INC_B") == str(tmp_path / "b" / "inc_b.nss")
+    assert sorted(index.files()) == [
+        str(tmp_path / "a" / "inc_a.nss"),
+        str(tmp_path / "b" / "inc_b.nss"),
+        str(tmp_path / "b" / "inc_c.nss"),
+    ]
+
+    assert not index.remove(str(tmp_path / "b" / "inc_b.nss"))
+    assert index.remove(str(tmp_path / "b" / "inc_c.nss"))
+    assert index.paths() == [str(tmp_path / "a")]
+    assert index.find("inc_b") is None
+
+
+def test_document_cache() -> None:
+    """Test that parsed documents are only reused for the same version."""
+    cache = DocumentCache()
+    cache.put("file:///a.nss", 1, "parsed-1")
+    assert cache.get("file:///a.nss", 1) == "parsed-1"
+    assert cache.get("file:///a.nss", 2) is None
+
+    cache.put("file:///a.nss", 2, "parsed-2")
+    assert cache.get("file:///a.nss", 1) is None
+    assert cache.get("file:///a.nss", 2) == "parsed-2"
+
+    cache.put("file:///b.nss", None, "from-disk")
+    assert "file:///b.nss" not in cache
+
+    cache.remove("file:///a.nss")
+    assert len(cache) == 0
+
+
+def test_document_cache_closed_budget() -> None:
+    """Test that closed documents are kept by content hash within the budget."""
+    cache = DocumentCache(budget=250 * SIZE_PER_CHAR)
+    cache.put("file:///a.nss", 1, "parsed-a", "hash-a", 100)
+    cache.put("file:///b.nss", 1, "parsed-b", "hash-b", 100)
+    cache.close("file:///a.nss")
+    cache.close("file:///b.nss")
+    assert "file:///a.nss" not in cache
+    assert cache.memory()["closed_bytes"] == 200 * SIZE_PER_CHAR
+
+    # Changed content, or another document with the same content, is reparsed
+    assert cache.reopen("file:///a.nss", "hash-b") is None
+    assert cache.reopen("file:///c.nss", "hash-a") is None
+    assert cache.reopen("file:///a.nss", "hash-a") == "parsed-a"
+    assert cache.reopen("file:///a.nss", "hash-a") is None
+
+    # Closing c goes over budget, dropping b which was closed first
+    cache.put("file:///a.nss", 2, "parsed-a", "hash-a", 100)
+    cache.put("file:///c.nss", 1, "parsed-c", "hash-c", 100)
+    cache.close("file:///a.nss")
+    cache.close("file:///c.nss")
+    assert cache.reopen("file:///b.nss", "hash-b") is None
+    assert cache.memory()["closed"] == 2
+    assert cache.reopen("file:///c.nss", "hash-c") == "parsed-c"
+
+    cache.clear_closed()
+    assert cache.memory()["closed_bytes"] == 0
+
+
+def test_debouncer_coalesces_calls() -> None:
+    """Test that bursts of scheduled calls run once with the last arguments."""
+    loop = asyncio.new_event_loop()
+    debouncer = Debouncer(loop, delay=0.01)
+    calls = []
+
+    for i in range(5):
+        debouncer.schedule("a", calls.append, i)
+    debouncer.schedule("b", calls.append, "b")
+    debouncer.schedule("c", calls.append, "c")
+    assert debouncer.cancel("c")
+
+    loop.run_until_complete(asyncio.sleep(0.05))
+    loop.close()
+
+    assert sorted(calls, key=str) == [4, "b"]
+    assert "a" not in debouncer
+
+
+def test_worker_pool_shares_pending_work() -> None:
+    """Test that concurrent calls for the same key share one execution."""
+    pool = WorkerPool(max_workers=2)
+    calls = []
+    release = threading.Event()
+
+    def work(value):
+        calls.append(value)
+        release.wait(1)
+        return value * 2
+
+    async def run():
+        first = asyncio.ensure_future(pool.run_once("a", work, 1))
+        second = asyncio.ensure_future(pool.run_once("a", work, 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        release.set()
+        return await second
+
+    assert asyncio.run(run()) == 2
+    assert calls == [1]
+    pool.shutdown()
+
+
+def test_worker_pool_cancels_abandoned_work() -> None:
+    """Test that tokens are cancelled once nobody waits for the work."""
+    pool = WorkerPool(max_workers=2)
+    started = threading.Event()
+
+    def work(token):
+        started.set()
+        for _ in range(100):
+            token.check()
+            threading.Event().wait(0.01)
+        return "done"
+
+    async def run():
+        abandoned = CancellationToken()
+        first = asyncio.ensure_future(pool.run_once("a", work, abandoned, token=abandoned))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 1)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert abandoned.cancelled
+
+        outdated = CancellationToken()
+        second = asyncio.ensure_future(pool.run_once(("parse", 1), work, outdated, token=outdated))
+        third = asyncio.ensure_future(pool.run_once(("parse", 2), work, CancellationToken()))
+        await asyncio.sleep(0.01)
+        pool.cancel(lambda key: key[1] == 1)
+        with pytest.raises(Cancelled):
+            await second
+        third.cancel()
+
+    asyncio.run(run())
+    pool.shutdown()
+
+
+def test_worker_pool_keeps_a_thread_for_interactive_work() -> None:
+    """Test that interactive work runs while background work fills the queue."""
+    pool = WorkerPool(max_workers=2)
+    release = threading.Event()
+
+    async def run():
+        with priority(BACKGROUND):
+            background = [asyncio.ensure_future(pool.run(release.wait, 1)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        depths = pool.queue_depths()
+        assert depths["background"] == {"queued": 2, "running": 1}
+
+        assert await asyncio.wait_for(pool.run(lambda: "hover"), 0.5) == "hover"
+        release.set()
+        await asyncio.gather(*background)
+        assert pool.queue_depths()["background"] == {"queued": 0, "running": 0}
+
+    asyncio.run(run())
+    pool.shutdown()
+
+
+def test_priority_lock_prefers_urgent_waiters() -> None:
+    """Test that a released priority lock goes to the most urgent waiter."""
+    lock = PriorityLock()
+    order = []
+
+    def wait(value):
+        set_priority(value)
+        with lock:
+            order.append(value)
+
+    lock.acquire()
+    threads = []
+    for value in [BACKGROUND, DIAGNOSTICS, INTERACTIVE, BACKGROUND]:
+        thread = threading.Thread(target=wait, args=(value,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.01)
+    lock.release()
+
+    for thread in threads:
+        thread.join(1)
+    assert order == [INTERACTIVE, DIAGNOSTICS, BACKGROUND, BACKGROUND]
+    assert not lock.locked()
+
+
+def test_line_indexed_document_matches_pygls() -> None:
+    """Test that incremental edits produce the same text as pygls."""
+    source = "void main() {\n    int x = 1;\n\n    x += 2;\n}"
+    expected = TextDocument("file:///test.nss", source)
+    document = LineIndexedDocument("file:///test.nss", source)
+    rng = random.Random(42)
+
+    for _ in range(200):
+        lines = expected.lines
+        start_line = rng.randrange(len(lines) + 1)
+        end_line = rng.randrange(start_line, len(lines) + 1)
+        start = lsp.Position(start_line, rng.randrange(
+            len(lines[start_line]) + 1) if start_line < len(lines) else 0)
+        end = lsp.Position(end_line, rng.randrange(
+            len(lines[end_line]) + 1) if end_line < len(lines) else 0)
+        if end_line == start_line and end.character < start.character:
+            start, end = end, start
+
+        change = lsp.TextDocumentContentChangeEvent_Type1(
+            range=lsp.Range(start, end),
+            text=rng.choice(["", "a", "b\n", "\n\n", "int y;\n    y = 3;"]),
+        )
+        expected.apply_change(change)
+        document.apply_change(change)
+
+        assert document.source == expected.source
+        assert document.lines == expected.lines
+        position = lsp.Position(rng.randrange(len(expected.lines) + 1), 0)
+        assert document.offset_at_position(position) == expected.offset_at_position(position)
+
+
+def test_dependency_graph_transitive_dependents() -> None:
+    """Test that dependents are found through chains of includes."""
+    graph = DependencyGraph()
+    graph.set_includes("main", ["inc_b"])
+    graph.set_includes("inc_b", ["INC_A"])
+    graph.set_includes("other", ["inc_c"])
+
+    assert graph.dependents("inc_a") == {"inc_b"}
+    assert graph.transitive_dependents("inc_a") == {"inc_b", "main"}
+
+    graph.set_includes("main", ["inc_c"])
+    assert graph.transitive_dependents("inc_a") == {"inc_b"}
+    assert graph.transitive_dependents("inc_c") == {"main", "other"}
+
+    graph.remove("other")
+    assert graph.dependents("inc_c") == {"main"}
+
+
+def test_diagnostic_result_ids_follow_includes() -> None:
+    """Test that result ids change with the document and its includes."""
+    graph = DependencyGraph()
+    graph.set_includes("main", ["inc_b"])
+    graph.set_includes("inc_b", ["inc_a"])
+
+    first = make_result_id("session", "void main() {}", graph.fingerprint("main"))
+    assert first == make_result_id("session", "void main() {}", graph.fingerprint("main"))
+    assert first != make_result_id("other", "void main() {}", graph.fingerprint("main"))
+    assert first != make_result_id("session", "void main() { }", graph.fingerprint("main"))
+
+    graph.touch("unrelated")
+    assert first == make_result_id("session", "void main() {}", graph.fingerprint("main"))
+
+    graph.touch("inc_a")
+    assert first != make_result_id("session", "void main() {}", graph.fingerprint("main"))
+
+
+def test_symbol_cache_round_trip(tmp_path) -> None:
+    """Test that cached entries survive a reload but not a content or version change."""
+    cache_path = str(tmp_path / ".arclight" / "cache.json")
+    script = str(tmp_path / "inc_a.nss")
+    digest = content_hash("int AddOne(int x);")
+
+    cache = SymbolCache(str(tmp_path), cache_path, "1.0")
+    cache.put(script, digest, [{"name": "AddOne"}], ["nwscript"])
+    assert cache.dirty
+    cache.stage()
+    assert not cache.dirty
+    cache.flush()
+
+    reloaded = SymbolCache(str(tmp_path), cache_path, "1.0")
+    assert reloaded.load()
+    assert reloaded.get(script, digest)["includes"] == ["nwscript"]
+    assert reloaded.get(script, content_hash("")) is None
+    assert [path for path, _ in reloaded.items()] == [script]
+
+    assert not SymbolCache(str(tmp_path), cache_path, "2.0").load()
+
+
+def test_symbol_cache_appends_changes(tmp_path) -> None:
+    """Test that saving appends changed entries and compacts a log of mostly outdated lines."""
+    cache_path = tmp_path / "cache.jsonl"
+    cache = SymbolCache(str(tmp_path), str(cache_path), "1.0")
+    scripts = [str(tmp_path / f"inc_{i}.nss") for i in range(3)]
+    for script in scripts:
+        cache.put(script, "h1", [], [])
+    cache.save()
+    assert len(cache_path.read_text().splitlines()) == 4
+
+    cache.set_references(scripts[0], "h1", [["inc_0", "A", -1, -1, 0, 0, 0, 1]])
+    cache.remove(scripts[1])
+    cache.save()
+    assert len(cache_path.read_text().splitlines()) == 6
+
+    reloaded = SymbolCache(str(tmp_path), str(cache_path), "1.0")
+    assert reloaded.load()
+    assert sorted(path for path, _ in reloaded.items()) == [scripts[0], scripts[2]]
+    assert reloaded.get(scripts[0], "h1")["references"] == [["inc_0", "A", -1, -1, 0, 0, 0, 1]]
+
+    for i in range(100):
+        reloaded.put(scripts[2], f"h{i}", [], [])
+        reloaded.save()
+    assert len(cache_path.read_text().splitlines()) < 100
+    assert reloaded.load()
+    assert reloaded.get(scripts[2], "h99") is not None
+
+    # A save interrupted halfway only loses its last line
+    with open(cache_path, "a", encoding="utf-8") as f:
+        f.write('{"path": "inc_0.nss", "ent')
+    assert reloaded.load()
+    assert len(reloaded) == 2
+    reloaded.put(scripts[1], "h1", [], [])
+    reloaded.save()
+    assert reloaded.load()
+    assert len(reloaded) == 3
+
+
+def test_symbol_cache_drops_scripts_changed_on_disk(tmp_path) -> None:
+    """Test that entries of scripts changed or deleted on disk are found and dropped."""
+    cache = SymbolCache(str(tmp_path), str(tmp_path / "cache.jsonl"), "1.0")
+    for name in ("same", "changed", "deleted"):
+        script = tmp_path / f"{name}.nss"
+        script.write_text("void main() {}")
+        cache.put(str(script), content_hash("void main() {}"), [], [])
+    (tmp_path / "changed.nss").write_text("void main() { int x; }")
+    (tmp_path / "deleted.nss").unlink()
+
+    changed = changed_scripts(cache.hashes())
+    assert sorted(changed) == [str(tmp_path / "changed.nss"), str(tmp_path / "deleted.nss")]
+
+    # An entry written again while the scripts were checked is kept
+    cache.put(str(tmp_path / "changed.nss"), content_hash("void main() { int x; }"), [], [])
+    assert cache.drop(changed) == [str(tmp_path / "deleted.nss")]
+    assert sorted(path for path, _ in cache.items()) == [
+        str(tmp_path / "changed.nss"), str(tmp_path / "same.nss")]
+
+
+def test_symbol_cache_is_verified_after_initialize(tmp_path) -> None:
+    """Test that cached references are only indexed once their scripts are checked on a worker."""
+    cache = SymbolCache(str(tmp_path), str(tmp_path / ".arclight" / "nwscriptd-cache.jsonl"),
+                        server_module.metadata.version("rollnw"))
+    for name in ("same", "changed"):
+        script = tmp_path / f"{name}.nss"
+        script.write_text("void main() {}")
+        rng = {"start": {"line": 0, "character": 5}, "end": {"line": 0, "character": 9}}
+        cache.put(str(script), content_hash("void main() {}"), [
+            {"name": name, "kind": 12, "range": rng, "selectionRange": rng}], [])
+        cache.set_references(str(script), content_hash("void main() {}"),
+                             [[name, "main", -1, -1, 0, 5, 0, 9]])
+    cache.save()
+    (tmp_path / "changed.nss").write_text("void main() { int x; }")
+
+    server = SERVER.spawn()
+
+    async def run():
+        server_module._load_symbol_cache(server, str(tmp_path))
+        assert len(server.symbol_index) == 2
+        assert len(server.reference_index) == 0
+
+        await server.cache_task
+        assert len(server.symbol_index) == 1
+        assert server.reference_index.references(SymbolKey("same", "main")) == [
+            (str(tmp_path / "same.nss"), (0, 5, 0, 9))]
+        assert server.reference_index.digest(str(tmp_path / "changed.nss")) is None
+
+    server.loop.run_until_complete(run())
+
+def test_fuzzy_rank_prefers_prefix_and_word_boundaries() -> None:
+    """Test fuzzy matching order of candidates."""
+    assert fuzzy_score("gli", "GetLocalInt") is not None
+    assert fuzzy_score("xyz", "GetLocalInt") is None
+
+    names = ["SetLocalInt", "GetLocalInt", "GetLocalString", "GetIsPC"]
+    assert fuzzy_rank("GetLocalI", names, key=str) == ["GetLocalInt", "GetLocalString"]
+    assert fuzzy_rank("gli", names, key=str)[0] == "GetLocalInt"
+    assert fuzzy_rank("get", names, key=str, limit=2) == ["GetIsPC", "GetLocalInt"]
+
+
+def test_symbol_index_search() -> None:
+    """Test that the symbol index finds substrings and abbreviations."""
+    def symbol(name):
+        rng = {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": len(name)}}
+        return {"name": name, "kind": 12, "range": rng, "selectionRange": rng}
+
+    index = SymbolIndex()
+    index.update("/ws/inc_util.nss", [symbol("GetLocalIntSafe"), symbol("UtilLog")])
+    index.update("/ws/inc_pc.nss", [symbol("GetIsPlayer")])
+
+    assert [s.name for s in index.search("LocalInt")] == ["GetLocalIntSafe"]
+    assert [s.name for s in index.search("gli")] == ["GetLocalIntSafe"]
+    assert [s.name for s in index.search("Get")] == ["GetIsPlayer", "GetLocalIntSafe"]
+
+    index.update("/ws/inc_util.nss", [symbol("UtilLog")])
+    assert index.search("LocalInt") == []
+    index.remove("/ws/inc_pc.nss")
+    assert len(index) == 1
+
+
+def test_workspace_symbol_handler(monkeypatch) -> None:
+    """Test that workspace/symbol is registered and answered from the index."""
+    assert lsp.WORKSPACE_SYMBOL in SERVER.lsp.fm.features
+    monkeypatch.setattr(SERVER, "symbol_index", SymbolIndex())
+
+    rng = {"start": {"line": 4, "character": 4}, "end": {"line": 4, "character": 19}}
+    SERVER.symbol_index.update("/ws/inc_util.nss", [
+        {"name": "GetLocalIntSafe", "kind": 12, "range": rng, "selectionRange": rng},
+    ])
+    symbols = workspace_symbol(SERVER, lsp.WorkspaceSymbolParams(query="gli"))
+    assert symbols == [lsp.SymbolInformation(
+        name="GetLocalIntSafe",
+        kind=lsp.SymbolKind.Function,
+        location=lsp.Location("file:///ws/inc_util.nss", lsp.Range(
+            lsp.Position(4, 4), lsp.Position(4, 19))),
+    )]
+
+
+def test_reference_index_replaces_scripts() -> None:
+    """Test that references are looked up by declaration and replaced per script."""
+    index = ReferenceIndex()
+    index.update("/ws/a.nss", "h1", [
+        ["inc_util", "AddOne", -1, -1, 3, 4, 3, 10],
+        ["a", "i", 2, 8, 4, 0, 4, 1],
+    ])
+    index.update("/ws/b.nss", "h2", [["inc_util", "AddOne", -1, -1, 7, 2, 7, 8]])
+
+    assert index.digest("/ws/a.nss") == "h1"
+    assert sorted(index.references(SymbolKey("inc_util", "AddOne"))) == [
+        ("/ws/a.nss", (3, 4, 3, 10)),
+        ("/ws/b.nss", (7, 2, 7, 8)),
+    ]
+    assert index.references(SymbolKey("a", "i", 2, 8)) == [("/ws/a.nss", (4, 0, 4, 1))]
+
+    index.update("/ws/a.nss", "h3", [])
+    assert index.references(SymbolKey("inc_util", "AddOne")) == [("/ws/b.nss", (7, 2, 7, 8))]
+    assert index.references(SymbolKey("a", "i", 2, 8)) == []
+
+    index.remove("/ws/b.nss")
+    assert index.references(SymbolKey("inc_util", "AddOne")) == []
+    assert index.digest("/ws/b.nss") is None
+
+
+def test_completion_item_cache_tracks_revisions() -> None:
+    """Test that prebuilt completion items are only returned for their revision."""
+    cache = CompletionItemCache()
+    items = [lsp.CompletionItem(label="GetLocalInt")]
+    cache.put("nwscript", 0, items)
+    assert cache.get("nwscript", 0) is items
+    assert cache.get("nwscript", 1) is None
+
+    cache.put("nwscript", 1, [])
+    assert cache.get("nwscript", 0) is None
+    assert len(cache) == 1
+
+    cache.remove("nwscript")
+    assert "nwscript" not in cache
+
+
+def test_rank_completions_truncates_and_orders() -> None:
+    """Test that completions are ranked on the prefix without touching shared items."""
+    items = [lsp.CompletionItem(label=label)
+             for label in ["SetLocalInt", "GetLocalInt", "GetLocalString", "GetIsPC"]]
+
+    ranked, truncated = _rank_completions(items, "GetLoc", 1)
+    assert [item.label for item in ranked] == ["GetLocalInt"]
+    assert ranked[0].sort_text == "00000"
+    assert truncated
+    assert all(item.sort_text is None for item in items)
+
+    ranked, truncated = _rank_completions(items, "GetLoc", 10, data=7)
+    assert [item.label for item in ranked] == ["GetLocalInt", "GetLocalString"]
+    assert not truncated
+    assert all(item.data == 7 for item in ranked)
+
+
+def test_markup_cache_evicts_and_invalidates() -> None:
+    """Test that rendered markup is bounded and dropped per provider."""
+    cache = MarkupCache(maxsize=2)
+    content = lsp.MarkupContent(lsp.MarkupKind.PlainText, "int GetLocalInt()")
+    cache.put(("nwscript", 0, "GetLocalInt"), content)
+    cache.put(("inc_util", 0, "AddOne"), content)
+    assert cache.get(("nwscript", 0, "GetLocalInt")) is content
+
+    # The least recently used entry goes first
+    cache.put(("inc_util", 0, "AddTwo"), content)
+    assert cache.get(("inc_util", 0, "AddOne")) is None
+    assert len(cache) == 2
+
+    cache.invalidate("inc_util")
+    assert cache.get(("inc_util", 0, "AddTwo")) is None
+    assert cache.get(("nwscript", 0, "GetLocalInt")) is content
+
+
+def test_inlay_hint_cache_slices_chunks() -> None:
+    """Test that hints are stored per chunk and sliced to a requested range."""
+    def hint(line, character):
+        return lsp.InlayHint(lsp.Position(line, character), "nValue: ")
+
+    def span(start, end):
+        return lsp.Range(lsp.Position(start, 0), lsp.Position(end, 0))
+
+    cache = InlayHintCache(chunk_lines=10)
+    assert cache.missing("file:///a.nss", 1, 5, 25) == [0, 1, 2]
+    assert cache.get("file:///a.nss", 1, span(0, 5)) is None
+
+    # Hints outside of the chunk are dropped
+    cache.put("file:///a.nss", 1, 0, [hint(9, 4), hint(2, 8), hint(12, 0)])
+    cache.put("file:///a.nss", 1, 1, [hint(12, 0), hint(15, 3)])
+    assert cache.missing("file:///a.nss", 1, 5, 25) == [2]
+
+    hints = cache.get("file:///a.nss", 1, span(3, 13))
+    assert [(h.position.line, h.position.character) for h in hints] == [(9, 4), (12, 0)]
+
+    assert cache.get("file:///a.nss", 2, span(3, 13)) is None
+    cache.put("file:///a.nss", 2, 0, [])
+    assert cache.missing("file:///a.nss", 2, 0, 15) == [1]
+
+
+def test_prefetch_is_cancelled_when_document_closes() -> None:
+    """Test that background work on a document is tracked and cancelled when it closes."""
+    server = SERVER.spawn()
+    uri = "file:///ws/test.nss"
+
+    async def wait():
+        await asyncio.sleep(10)
+
+    async def run():
+        task = server.prefetch(uri, wait)
+        other = server.prefetch("file:///ws/other.nss", wait)
+        await asyncio.sleep(0)
+        assert server.prefetch_tasks[uri] == {task}
+
+        did_close(server, lsp.DidCloseTextDocumentParams(lsp.TextDocumentIdentifier(uri)))
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled() and uri not in server.prefetch_tasks
+        assert not other.done()
+
+        server.cancel_prefetch()
+        await asyncio.gather(other, return_exceptions=True)
+        assert server.prefetch_tasks == {}
+
+    server.loop.run_until_complete(run())
+
+
+def test_semantic_tokens_encode_and_diff() -> None:
+    """Test relative token encoding and that deltas reproduce the new tokens."""
+    assert encode([
+        SemanticToken(0, 4, 3, 0),
+        SemanticToken(0, 10, 2, 1, 1),
+        SemanticToken(2, 1, 5, 2),
+    ]) == [0, 4, 3, 0, 0, 0, 6, 2, 1, 1, 2, 1, 5, 2, 0]
+    assert diff([0, 4, 3, 0, 0], [0, 4, 3, 0, 0]) == []
+
+    rng = random.Random(7)
+    for _ in range(200):
+        old = [rng.randrange(3) for _ in range(5 * rng.randrange(8))]
+        new = list(old)
+        start = 5 * rng.randrange(len(new) // 5 + 1)
+        del new[start:start + 5 * rng.randrange(3)]
+        new[start:start] = [rng.randrange(3) for _ in range(5 * rng.randrange(3))]
+
+        patched = list(old)
+        for edit in reversed(diff(old, new)):
+            assert edit.start % 5 == 0 and edit.delete_count % 5 == 0
+            patched[edit.start:edit.start + edit.delete_count] = edit.data
+        assert patched == new
+
+
+def test_stats_percentiles() -> None:
+    """Test that histograms estimate percentiles within a bucket."""
+    stats = Stats()
+    for ms in range(1, 101):
+        stats.record("method", "textDocument/hover", ms / 1000)
+    with stats.timer("phase", "parse"):
+        pass
+
+    snapshot = stats.snapshot()
+    hover = snapshot["method"]["textDocument/hover"]
+    assert hover["count"] == 100
+    assert hover["mean"] == 50.5
+    assert 32 <= hover["p50"] <= 64
+    assert 64 <= hover["p95"] <= 100
+    assert hover["p99"] <= hover["max"] == 100
+    assert snapshot["phase"]["parse"]["count"] == 1
+
+    stats.reset()
+    assert stats.snapshot() == {}
+
+
+def test_notifications_and_writes_are_timed(monkeypatch) -> None:
+    """Test that async notifications are timed until done and writes apart from serialization."""
+    server = SERVER.spawn()
+    server.stats = Stats()
+    written = []
+
+    class Transport:
+        def write(self, data):
+            written.append(data)
+
+    done = asyncio.Event()
+
+    async def handler(params):
+        await done.wait()
+
+    async def run():
+        monkeypatch.setattr(server.lsp, "_get_handler", lambda name: handler)
+        server.lsp._handle_notification(lsp.TEXT_DOCUMENT_DID_OPEN, None)
+        await asyncio.sleep(0)
+        assert "method" not in server.stats.snapshot()
+        done.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    server.loop.run_until_complete(run())
+    assert server.stats.snapshot()["method"][lsp.TEXT_DOCUMENT_DID_OPEN]["count"] == 1
+
+    server.lsp.transport = Transport()
+    server.lsp._send_data({"jsonrpc": "2.0", "method": "window/logMessage"})
+    assert written and written[0].endswith(b'"method": "window/logMessage"}')
+    phases = server.stats.snapshot()["phase"]
+    assert phases["serialize"]["count"] == phases["write"]["count"] == 1
+
+
+def test_session_recorder_round_trip(tmp_path) -> None:
+    """Test that recorded messages are read back in order with their timing."""
+    path = str(tmp_path / "session.jsonl")
+    recorder = SessionRecorder(path)
+    request = {"jsonrpc": "2.0", "id": 1, "method": "textDocument/hover", "params": {}}
+    recorder.record("in", json.dumps(request))
+    recorder.record("out", json.dumps({"jsonrpc": "2.0", "id": 1, "result": None}))
+    recorder.close()
+    recorder.record("out", "{}")
+
+    entries = list(read_session(path))
+    assert [e["direction"] for e in entries] == ["in", "out"]
+    assert entries[0]["message"] == request
+    assert entries[0]["time"] <= entries[1]["time"]
+
+
+def test_kernel_loader_starts_once_in_background(monkeypatch) -> None:
+    """Test that the kernel starts off the event loop, once, with its options."""
+    calls = []
+    started = threading.Event()
+
+    def fake_start(lock, include_install, include_user):
+        started.wait(5)
+        calls.append((include_install, include_user))
+
+    monkeypatch.setattr(kernel, "_start_kernel", fake_start)
+
+    async def main():
+        loader = kernel.KernelLoader()
+        loader.include_user = False
+        lock = threading.Lock()
+        first = loader.start(lock)
+        assert loader.start(lock) is first
+        assert loader.started and not loader.ready
+
+        started.set()
+        await loader.wait()
+        assert loader.ready
+
+    asyncio.run(main())
+    assert calls == [(True, False)]
+
+
+def test_daemon_shares_workspace_state() -> None:
+    """Test that daemon clients share a workspace's indexes but not documents."""
+    daemon = Daemon(SERVER)
+    first = daemon.connect()._server
+    second = daemon.connect()._server
+    other = daemon.connect()._server
+    assert first is not SERVER and first.lsp is not second.lsp
+    assert first.lsp.fm.features.keys() == SERVER.lsp.fm.features.keys()
+    assert first.lsp.fm.commands.keys() == SERVER.lsp.fm.commands.keys()
+    assert first.kernel is SERVER.kernel and first.workers is SERVER.workers
+
+    assert not daemon.attach(first, "/work/module")
+    assert daemon.attach(second, "/work/module/")
+    assert not daemon.attach(other, "/work/other")
+    assert second.symbol_index is first.symbol_index
+    assert second.script_context is first.script_context
+    assert second.documents is not first.documents
+    assert other.symbol_index is not first.symbol_index
+    assert second.workspace_state is first.workspace_state
+    assert first not in vars(first.workspace_state).values()
+    assert first.peers() == [first, second]
+
+    daemon.watch(first)
+    daemon.watch(second)
+    assert daemon.handles_watched_files(first)
+    assert not daemon.handles_watched_files(second)
+
+    async def run():
+        token = CancellationToken()
+        job = asyncio.ensure_future(first.workers.run_once(
+            ("parse", first.session_id, "file:///work/module/a.nss", 1, 0),
+            threading.Event().wait, 0.01, token=token))
+        await asyncio.sleep(0)
+        daemon.disconnect(first)
+        assert token.cancelled
+        await asyncio.gather(job, return_exceptions=True)
+
+    asyncio.run(run())
+    assert daemon.handles_watched_files(second)
+    assert second.peers() == [second]
+    assert other.peers() == [other]
+
+
+def test_cancel_outdated_keeps_other_clients_work() -> None:
+    """Test that a daemon client's edit doesn't cancel another client's work on the same uri."""
+    first, second = SERVER.spawn(), SERVER.spawn()
+    first.workers = second.workers = pool = WorkerPool(max_workers=2)
+    uri = "file:///ws/test.nss"
+
+    def work(token):
+        for _ in range(100):
+            token.check()
+            threading.Event().wait(0.01)
+        return "done"
+
+    async def run():
+        jobs = []
+        for ls in (first, second):
+            token = CancellationToken()
+            jobs.append(asyncio.ensure_future(pool.run_once(
+                ("parse", ls.session_id, uri, 1, 0), work, token, token=token)))
+        await asyncio.sleep(0.01)
+        _cancel_outdated(first, uri, 2)
+        with pytest.raises(Cancelled):
+            await jobs[0]
+        assert await jobs[1] == "done"
+
+    asyncio.run(run())
+    pool.shutdown()
+
+
+def test_spawned_servers_share_one_rollnw_lock() -> None:
+    """Test that every client of a daemon takes the same lock before using rollnw."""
+    first, second = SERVER.spawn(), SERVER.spawn()
+    assert first.script_context is not second.script_context
+    assert first.script_context.lock is second.script_context.lock is SERVER.script_context.lock
+
+
+def test_preindexed_script_feeds_the_indexes(tmp_path, monkeypatch) -> None:
+    """Test that a script indexed by a pool process lands in the server's indexes."""
+    source = "void Helper() {}\n"
+    script = tmp_path / "inc_util.nss"
+    script.write_text(source)
+    rng = lsp.Range(lsp.Position(0, 5), lsp.Position(0, 11))
+    symbol = lsp.DocumentSymbol(name="Helper", kind=lsp.SymbolKind.Function, range=rng,
+                                selection_range=rng, detail="(function)")
+    reference = ["inc_util", "Helper", -1, -1, 0, 5, 0, 11]
+
+    # rollnw needs a game install, stand in for its analysis
+    monkeypatch.setattr(analysis, "parse_nss", lambda *args: (None, ["nwscript"], [symbol]))
+    monkeypatch.setattr(analysis, "scan_references", lambda *args: [reference])
+
+    entry = preindex.index_script(str(script), [str(tmp_path)], None)
+    assert entry["hash"] == content_hash(source)
+    assert entry["includes"] == ["nwscript"]
+    assert entry["exports"][0]["name"] == "Helper"
+    assert preindex.index_script(str(script), [str(tmp_path)], entry["hash"]) is None
+
+    monkeypatch.setattr(kernel, "_start_kernel", lambda *args: None)
+    server = SERVER.spawn()
+    server.kernel = KernelLoader()
+
+    async def initialize():
+        return server.lsp.lsp_initialize(lsp.InitializeParams(capabilities=lsp.ClientCapabilities()))
+
+    asyncio.run(initialize())
+    assert _add_preindexed(server, entry)
+    assert [found.name for found in server.symbol_index.search("helper", 10)] == ["Helper"]
+    assert server.reference_index.digest(str(script)) == entry["hash"]
+    assert server.reference_index.references(SymbolKey("inc_util", "Helper")) == [
+        (str(script), (0, 5, 0, 11))]
+
+
+def test_revalidate_asks_pull_clients_to_refresh() -> None:
+    """Test that clients pulling diagnostics are asked to pull again after an include change."""
+    server = SERVER.spawn()
+    scheduled = []
+    server.diagnostics_debouncer.schedule = lambda key, *args: scheduled.append(key)
+    server.lsp.client_capabilities = lsp.ClientCapabilities(
+        text_document=lsp.TextDocumentClientCapabilities(
+            diagnostic=lsp.DiagnosticClientCapabilities()),
+        workspace=lsp.WorkspaceClientCapabilities(
+            diagnostics=lsp.DiagnosticWorkspaceClientCapabilities(refresh_support=True)))
+
+    _revalidate([(server, "file:///ws/a.nss"), (server, "file:///ws/b.nss")])
+    assert scheduled == ["file:///ws/a.nss", "refresh", "file:///ws/b.nss", "refresh"]
+
+    scheduled.clear()
+    server.lsp.client_capabilities = lsp.ClientCapabilities(
+        text_document=lsp.TextDocumentClientCapabilities(
+            diagnostic=lsp.DiagnosticClientCapabilities()))
+    _revalidate([(server, "file:///ws/a.nss")])
+    assert scheduled == ["file:///ws/a.nss"]
+
+
+def test_worker_threads_option(monkeypatch) -> None:
+    """Test that the interactive thread is always kept and daemon clients can't resize the pool."""
+    monkeypatch.setattr(kernel, "_start_kernel", lambda *args: None)
+
+    def initialize(server, threads):
+        server.kernel = KernelLoader()
+        server.workers = WorkerPool()
+
+        async def run():
+            server.lsp.lsp_initialize(lsp.InitializeParams(
+                capabilities=lsp.ClientCapabilities(),
+                initialization_options={"workerThreads": threads}))
+
+        asyncio.run(run())
+        return server.workers.max_workers
+
+    assert initialize(SERVER.spawn(), 1) == 2
+    assert initialize(SERVER.spawn(), 4) == 4
+
+    client = SERVER.spawn()
+    client.daemon = Daemon(SERVER)
+    assert initialize(client, 8) == 2
+
+
+def test_workspace_diagnostics_report_indexed_scripts(tmp_path, monkeypatch) -> None:
+    """Test that workspace diagnostics cover closed indexed scripts, parsing only changed ones."""
+    for name in ("inc_util", "main", "unindexed"):
+        (tmp_path / f"{name}.nss").write_text("void main() {}\n")
+
+    parsed = []
+
+    def diagnostics(ctx, stats, path, include_paths, source, cancel):
+        parsed.append(os.path.basename(path))
+        return [lsp.Diagnostic(lsp.Range(lsp.Position(0, 0), lsp.Position(0, 4)), source)]
+
+    monkeypatch.setattr(kernel, "_start_kernel", lambda *args: None)
+    monkeypatch.setattr(server_module, "_closed_script_diagnostics", diagnostics)
+    server = SERVER.spawn()
+    server.kernel = KernelLoader()
+
+    async def run():
+        server.lsp.lsp_initialize(lsp.InitializeParams(
+            capabilities=lsp.ClientCapabilities(), root_uri=f"file://{tmp_path}"))
+        server.dependencies.set_includes("inc_util", [])
+        server.dependencies.set_includes("main", ["inc_util"])
+
+        report = await workspace_diagnostic(server, lsp.WorkspaceDiagnosticParams([]))
+        assert [item.kind for item in report.items] == ["full", "full"]
+        assert [item.uri for item in report.items] == [
+            f"file://{tmp_path}/inc_util.nss", f"file://{tmp_path}/main.nss"]
+        assert sorted(parsed) == ["inc_util.nss", "main.nss"]
+
+        previous = [lsp.PreviousResultId(item.uri, item.result_id) for item in report.items]
+        report = await workspace_diagnostic(server, lsp.WorkspaceDiagnosticParams(previous))
+        assert [item.kind for item in report.items] == ["unchanged", "unchanged"]
+
+        # A change to an include is reported by the scripts including it
+        (tmp_path / "inc_util.nss").write_text("void Helper() {}\n")
+        report = await workspace_diagnostic(server, lsp.WorkspaceDiagnosticParams(previous))
+        assert [item.kind for item in report.items] == ["full", "unchanged"]
+        server.dependencies.touch("inc_util")
+        report = await workspace_diagnostic(server, lsp.WorkspaceDiagnosticParams(previous))
+        assert [item.kind for item in report.items] == ["full", "full"]
+        assert sorted(parsed) == ["inc_util.nss", "inc_util.nss", "main.nss", "main.nss"]
+
+    server.loop.run_until_complete(run())
+
+
+def test_watched_script_changes_are_reindexed(tmp_path, monkeypatch) -> None:
+    """Test that a script changed on disk keeps its references until it is indexed again."""
+    script = tmp_path / "inc_util.nss"
+    script.write_text("void Helper() {}\n")
+    other = tmp_path / "main.nss"
+    other.write_text("void main() {}\n")
+    uri = f"file://{script}"
+    reference = ["inc_util", "Helper", -1, -1, 0, 5, 0, 11]
+
+    monkeypatch.setattr(kernel, "_start_kernel", lambda *args: None)
+    monkeypatch.setattr(server_module, "index_script", lambda ctx, stats, path, *args: {
+        "path": path, "hash": "new", "includes": [], "exports": [], "references": [reference]})
+    server = SERVER.spawn()
+    server.kernel = KernelLoader()
+
+    async def run():
+        server.lsp.lsp_initialize(lsp.InitializeParams(
+            capabilities=lsp.ClientCapabilities(), root_uri=f"file://{tmp_path}"))
+        server.reference_index.update(str(script), "old", [reference, reference])
+        server.reference_index.update(str(other), "old", [])
+
+        did_change_watched_files(server, lsp.DidChangeWatchedFilesParams(changes=[
+            lsp.FileEvent(uri=uri, type=lsp.FileChangeType.Changed)]))
+        assert len(server.reference_index.references(SymbolKey("inc_util", "Helper"))) == 2
+        assert uri in server.reference_debouncer
+        assert str(script) in server.stale_references
+
+        # Renaming with the stale references is refused and indexing starts
+        async def located(*args):
+            return SymbolKey("inc_util", "Helper"), lsp.Location(uri, lsp.Range(
+                lsp.Position(0, 5), lsp.Position(0, 11)))
+
+        async def indexed(*args):
+            pass
+
+        monkeypatch.setattr(server_module, "_locate_declaration", located)
+        monkeypatch.setattr(server_module, "_index_references", indexed)
+        rename = lsp.RenameParams(text_document=lsp.TextDocumentIdentifier(uri=uri),
+                                  position=lsp.Position(0, 6), new_name="Assist")
+        assert await text_document_rename(server, rename) is None
+        await server.index_task
+        assert server.reference_index.digest(str(script)) == "new"
+        assert not server.stale_references
+
+        edit = await text_document_rename(server, rename)
+        assert [e.new_text for e in edit.changes[uri]] == ["Assist"]
+
+        did_change_watched_files(server, lsp.DidChangeWatchedFilesParams(changes=[
+            lsp.FileEvent(uri=uri, type=lsp.FileChangeType.Deleted)]))
+        assert server.reference_index.digest(str(script)) is None
+        assert uri not in server.reference_debouncer
+
+    server.loop.run_until_complete(run())
+
+
+def test_script_context_records_nested_includes() -> None:
+    """Test that a change to an include of an include drops the shared context."""
+    class Script:
+        def __init__(self, *includes):
+            self.includes = set(includes)
+
+        def dependencies(self):
+            return self.includes
+
+    class Context:
+        scripts = {"inc_b": Script("inc_a"), "inc_a": Script()}
+
+        def get(self, name):
+            return self.scripts.get(name)
+
+    context = ScriptContext()
+    context._ctx = Context()
+    assert context.record_includes(Script("inc_b")) == {"inc_a", "inc_b"}
+
+    assert not context.invalidate("inc_other")
+    assert context.invalidate("inc_a")
+    assert context.generation == 1
+    # Released by the next get, under the lock, not while workers may use it
+    assert context._ctx is not None
+    assert not context.invalidate("inc_b")